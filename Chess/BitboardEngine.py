@@ -0,0 +1,799 @@
+'''
+Bitboard backend for the GameState.
+The position is stored as twelve 64 bit integers, one for each piece, plus an occupancy mask for each side.
+Move generation works with shifts and masks instead of walking the board square by square.
+Square 0 is a8 and square 63 is h1, so a square is row * 8 + col.
+Use it with ChessEngine.GameState(backend="bitboard").
+'''
+
+from array import array
+
+from ChessEngine import GameState, EMPTY, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, WHITE, BLACK, SQ64, SQ120, \
+    GEN_CAPTURES, GEN_QUIETS, GEN_ALL, UNDO_CAPTURED, UNDO_HALFMOVE, UNDO_CASTLING, UNDO_EN_PASSANT, UNDO_HASH, \
+    UNDO_SIZE, PROMOTION_SHIFT, PROMOTION_FLAGS, CASTLES, CASTLE_ROOK, CASTLING_MASK, RAY_INDEX, \
+    DIRECTIONS as RAY_DIRECTIONS, ZOBRIST_PIECES, ZOBRIST_BLACK_TO_MOVE, ZOBRIST_CASTLING, ZOBRIST_EN_PASSANT
+
+#same order as GameState.checks_for_pins_and_checks, the first 4 are orthogonal and the last 4 diagonal
+DIRECTIONS = ((-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1))
+#the square index grows along these directions, so the first blocker is the lowest bit
+POSITIVE = (False, False, True, True, False, False, True, True)
+
+
+def _leaper_table(offsets):
+    table = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        mask = 0
+        for dr, dc in offsets:
+            if 0 <= r + dr < 8 and 0 <= c + dc < 8:
+                mask |= 1 << ((r + dr) * 8 + c + dc)
+        table.append(mask)
+    return table
+
+
+def _ray_table(d):
+    table = []
+    for sq in range(64):
+        r, c = divmod(sq, 8)
+        mask = 0
+        r += d[0]
+        c += d[1]
+        while 0 <= r < 8 and 0 <= c < 8:
+            mask |= 1 << (r * 8 + c)
+            r += d[0]
+            c += d[1]
+        table.append(mask)
+    return table
+
+
+def _between_table():
+    #between[a][b] has the squares strictly between a and b when they share a line, 0 otherwise
+    between = [[0] * 64 for _ in range(64)]
+    for a in range(64):
+        for d in DIRECTIONS:
+            r, c = divmod(a, 8)
+            squares = 0
+            r += d[0]
+            c += d[1]
+            while 0 <= r < 8 and 0 <= c < 8:
+                b = r * 8 + c
+                between[a][b] = squares
+                squares |= 1 << b
+                r += d[0]
+                c += d[1]
+    return between
+
+
+KNIGHT_ATTACKS = _leaper_table(((-2, -1), (-2, 1), (-1, -2), (-1, 2), (2, -1), (2, 1), (1, -2), (1, 2)))
+KING_ATTACKS = _leaper_table(DIRECTIONS)
+#squares attacked by a pawn of the given color standing on the square
+PAWN_ATTACKS = {WHITE: _leaper_table(((-1, -1), (-1, 1))), BLACK: _leaper_table(((1, -1), (1, 1)))}
+RAYS = [_ray_table(d) for d in DIRECTIONS]
+BETWEEN = _between_table()
+RANK_2 = 0xFF << 48
+RANK_7 = 0xFF << 8
+#the rows the pawns promote on
+LAST_RANKS = 0xFF | 0xFF << 56
+FULL = 0xFFFFFFFFFFFFFFFF
+FILE_A = 0x0101010101010101
+FILE_H = 0x8080808080808080
+#a8 and every square of the same color
+LIGHT_SQUARES = sum(1 << sq for sq in range(64) if (sq // 8 + sq % 8) % 2 == 0)
+
+#CASTLES with bitboard squares: (right, king end square, mask that must be empty, squares that must be safe)
+BB_CASTLES = {color: tuple((right, SQ64[king_end], sum(1 << SQ64[sq] for sq in empty_squares),
+                            tuple(SQ64[sq] for sq in safe_squares))
+                           for right, king_end, rook_sq, empty_squares, safe_squares in castles)
+              for color, castles in CASTLES.items()}
+
+#int.bit_count is only there from python 3.10
+try:
+    popcount = int.bit_count
+except AttributeError:
+    def popcount(bb):
+        return bin(bb).count('1')
+
+
+def ray_attacks(sq, occupied, d):
+    ray = RAYS[d][sq]
+    blockers = ray & occupied
+    if blockers:
+        if POSITIVE[d]:
+            first = (blockers & -blockers).bit_length() - 1
+        else:
+            first = blockers.bit_length() - 1
+        ray ^= RAYS[d][first]
+    return ray
+
+
+#ray walkers, only used to fill the magic tables and as the reference in bench_sliders.py
+def rook_attacks_classical(sq, occupied):
+    return ray_attacks(sq, occupied, 0) | ray_attacks(sq, occupied, 1) | \
+           ray_attacks(sq, occupied, 2) | ray_attacks(sq, occupied, 3)
+
+
+def bishop_attacks_classical(sq, occupied):
+    return ray_attacks(sq, occupied, 4) | ray_attacks(sq, occupied, 5) | \
+           ray_attacks(sq, occupied, 6) | ray_attacks(sq, occupied, 7)
+
+
+#magic bitboards: the blockers on the relevant squares of a slider (its rays without the last square)
+#are multiplied by the magic number of the square, the top bits of the product index a table that
+#already holds the attacks for that set of blockers
+#the numbers were found once with a random search (it takes about a minute in python) and the
+#tables are filled from them at import
+ROOK_MAGICS = (
+    0x0080002280400012, 0x0700108040002100, 0x2080200008801000, 0x9080048010020800,
+    0x1200081084201600, 0x8080020049040080, 0x010020840A004B00, 0x21000282210000C2,
+    0x4809800081400060, 0x0142400140201000, 0x00A1001060090040, 0x6005000910010020,
+    0x8405000411080100, 0x0001000649000400, 0x000A000948040200, 0x2001000042008500,
+    0x8440058000228A40, 0x0000828040082000, 0x0005010020001040, 0x2C801A0040120020,
+    0x0100710008008D00, 0x00E2880140200410, 0x0003040030080201, 0x1010020000409401,
+    0x6022C00180086080, 0x0020044040033000, 0x0004A00280100080, 0x0008008080100029,
+    0x0005001500180110, 0x00420002000C0810, 0x0008040101000200, 0x0000040200005181,
+    0x8020C00860800080, 0x0200400C84802000, 0x0008861000802000, 0x1110008010802801,
+    0x4018000880800400, 0x0810140080801200, 0x000002100C004508, 0x4200008042000904,
+    0x1080824000208005, 0x0108460981020020, 0x4121006001410050, 0x4026000860120040,
+    0x14820004600A0030, 0x408E000890060004, 0x00220E1041040088, 0x602002D184020001,
+    0x0000408000211100, 0x04C100C000802100, 0x48404020005D0100, 0x0002080080100080,
+    0x8080280080440080, 0x2009008248040100, 0x0412000801042200, 0x0000006884090200,
+    0x001A021880210242, 0x0052514001008027, 0x4540098010204202, 0x0009082010010501,
+    0x8401001002440801, 0x0001002A18840005, 0x4000100201280884, 0x01120B002C024082,
+)
+BISHOP_MAGICS = (
+    0x8011040301420200, 0x0809500902002900, 0x2011011403011000, 0x00080A0028040508,
+    0xA8D1104084000020, 0xC042082424084229, 0x4004020210140102, 0x0000210110032100,
+    0x0E011014C1080214, 0x0010040102020200, 0x0418040812104000, 0x0401022182000018,
+    0x0014420A10400440, 0x0C40020210450000, 0x0600008230100480, 0x040A060201040708,
+    0xB140001002020C04, 0x000400A025C20602, 0x9048001404240210, 0x0008000082014084,
+    0x0008800400A01090, 0x0000804100600213, 0x3808808108273001, 0x240040420200AC02,
+    0x1860084A22480101, 0x8803141121480204, 0x0020300148018060, 0x0820080081004028,
+    0x4001010008504000, 0x0402020020480240, 0x0801004002080420, 0x0084004000210400,
+    0x9088C2400010141A, 0x00C4251411200C20, 0x0C84020100080040, 0x8404040400080120,
+    0x4000420020020081, 0x8021080021420200, 0x0244080441008400, 0x00010C0280102600,
+    0x4684022010910400, 0x8201089005005020, 0x0102042024080800, 0x00A0002019000800,
+    0x0080400102102100, 0x0110A00480200101, 0x00900202040000C0, 0x44042481A1001A00,
+    0x421C020110080100, 0x800A048088080100, 0x0100410080B02040, 0x0030200142088101,
+    0x0210822420820208, 0x0030404244630000, 0x0020204C00808006, 0x0015500208410412,
+    0x0026050092100200, 0x8800282105101100, 0x8400400021841000, 0x00004003A0A0880D,
+    0x041383002004240A, 0x1000084008010D00, 0x0A0214A004210A00, 0x08202C0108010A10,
+)
+
+
+def _relevant_mask(sq, directions):
+    mask = 0
+    for d in directions:
+        ray = RAYS[d][sq]
+        #drop the edge square at the end of the ray, a blocker there changes nothing
+        if ray:
+            if POSITIVE[d]:
+                last = ray.bit_length() - 1
+            else:
+                last = (ray & -ray).bit_length() - 1
+            mask |= ray ^ (1 << last)
+    return mask
+
+
+def _magic_table(magics, directions, attacks):
+    table = []
+    for sq in range(64):
+        mask = _relevant_mask(sq, directions)
+        shift = 64 - bin(mask).count('1')
+        magic = magics[sq]
+        lookup = [0] * (1 << (64 - shift))
+        #walk every subset of the mask (carry rippler)
+        blockers = 0
+        while True:
+            lookup[((blockers * magic) & FULL) >> shift] = attacks(sq, blockers)
+            blockers = (blockers - mask) & mask
+            if not blockers:
+                break
+        table.append((mask, magic, shift, lookup))
+    return table
+
+
+ROOK_TABLE = _magic_table(ROOK_MAGICS, (0, 1, 2, 3), rook_attacks_classical)
+BISHOP_TABLE = _magic_table(BISHOP_MAGICS, (4, 5, 6, 7), bishop_attacks_classical)
+
+
+def rook_attacks(sq, occupied):
+    mask, magic, shift, lookup = ROOK_TABLE[sq]
+    return lookup[(((occupied & mask) * magic) & FULL) >> shift]
+
+
+def bishop_attacks(sq, occupied):
+    mask, magic, shift, lookup = BISHOP_TABLE[sq]
+    return lookup[(((occupied & mask) * magic) & FULL) >> shift]
+
+
+class BitboardGameState(GameState):
+
+    """
+    Same game state as GameState, but the legal moves are generated from the bitboards.
+    The mailbox board is still kept up to date because Move and ChessMain read pieces from it.
+    The piece square sets and the king rays are only filled by set_position, make and undo do not keep them.
+    """
+    def __init__(self, backend="bitboard"):
+        super().__init__(backend)
+
+    '''
+    Same as GameState.set_position, the bitboards are built from the board
+    '''
+    def set_position(self, squares, white_to_move, castling_rights, en_passant_sq, halfmove_clock):
+        super().set_position(squares, white_to_move, castling_rights, en_passant_sq, halfmove_clock)
+        self.bitboards, self.occupancy = self.bitboards_from_board()
+        self.checkers = 0
+        self.pinned = 0
+
+    '''
+    Bitboards and occupancy built from scratch from the mailbox board, also used as the debug cross check
+    '''
+    def bitboards_from_board(self):
+        #both are indexed by piece code and color code
+        bitboards = [0] * ((BLACK | KING) + 1)
+        occupancy = [0] * (BLACK + 1)
+        board = self.board
+        for i, sq in enumerate(SQ120):
+            piece = board[sq]
+            if piece != EMPTY:
+                bitboards[piece] |= 1 << i
+                occupancy[piece & (WHITE | BLACK)] |= 1 << i
+        return bitboards, occupancy
+
+    '''
+    Takes a packed move and executes it on the board and the bitboards. Same rules and undo record as
+    GameState.make_move_id, but the piece square sets and the king rays of the mailbox backend are not kept,
+    the masks replace them. The board stays up to date because Move and ChessMain read pieces from it
+    '''
+    def make_move_id(self, move_id):
+        board = self.board
+        bitboards = self.bitboards
+        occupancy = self.occupancy
+        start_sq = move_id & 63
+        end_sq = move_id >> 6 & 63
+        start = SQ120[start_sq]
+        end = SQ120[end_sq]
+        start_bit = 1 << start_sq
+        end_bit = 1 << end_sq
+        piece_moved = board[start]
+        piece_captured = board[end]
+        ally_color = piece_moved & (WHITE | BLACK)
+        type = piece_moved ^ ally_color
+        if self.ply == len(self.undo_stack):
+            self.undo_stack.extend([0] * UNDO_SIZE for _ in range(self.ply))
+        record = self.undo_stack[self.ply]
+        self.ply += 1
+        record[UNDO_HALFMOVE] = self.halfmove_clock
+        record[UNDO_CASTLING] = self.castling_rights
+        record[UNDO_EN_PASSANT] = self.en_passant_sq
+        record[UNDO_HASH] = key = self.zobrist_key
+        capture_sq = end
+        capture_bit = end_bit
+        if type == PAWN:
+            self.halfmove_clock = 0
+            if end == self.en_passant_sq:
+                #en passant, the captured pawn is next to the start square
+                if ally_color == WHITE:
+                    capture_sq, capture_bit = end + 10, end_bit << 8
+                else:
+                    capture_sq, capture_bit = end - 10, end_bit >> 8
+                piece_captured = board[capture_sq]
+                board[capture_sq] = EMPTY
+        elif piece_captured != EMPTY:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        record[UNDO_CAPTURED] = piece_captured
+        piece_placed = ally_color | move_id >> PROMOTION_SHIFT if move_id >> PROMOTION_SHIFT else piece_moved
+        board[start] = EMPTY
+        board[end] = piece_placed
+        bitboards[piece_moved] ^= start_bit
+        bitboards[piece_placed] ^= end_bit
+        occupancy[ally_color] ^= start_bit | end_bit
+        key ^= ZOBRIST_PIECES[piece_moved][start] ^ ZOBRIST_PIECES[piece_placed][end]
+        self.move_log.append(move_id)
+        if piece_captured != EMPTY:
+            bitboards[piece_captured] ^= capture_bit
+            occupancy[piece_captured & (WHITE | BLACK)] ^= capture_bit
+            key ^= ZOBRIST_PIECES[piece_captured][capture_sq]
+        if type == KING:
+            if ally_color == WHITE:
+                self.white_king_location = end
+            else:
+                self.black_king_location = end
+            #castling, the king moves two squares and the rook jumps over it
+            if end - start == 2 or end - start == -2:
+                rook_start, rook_end = CASTLE_ROOK[end]
+                board[rook_end] = board[rook_start]
+                board[rook_start] = EMPTY
+                rook = 1 << SQ64[rook_start] | 1 << SQ64[rook_end]
+                bitboards[ally_color | ROOK] ^= rook
+                occupancy[ally_color] ^= rook
+                key ^= ZOBRIST_PIECES[ally_color | ROOK][rook_start] ^ ZOBRIST_PIECES[ally_color | ROOK][rook_end]
+        key ^= ZOBRIST_CASTLING[self.castling_rights] ^ ZOBRIST_EN_PASSANT[self.en_passant_sq]
+        self.castling_rights &= CASTLING_MASK[start] & CASTLING_MASK[end]
+        self.en_passant_sq = 0
+        if type == PAWN and (end - start == 20 or end - start == -20):
+            enemy_pawn = (ally_color ^ (WHITE | BLACK)) | PAWN
+            if board[end - 1] == enemy_pawn or board[end + 1] == enemy_pawn:
+                self.en_passant_sq = (start + end) // 2
+        self.zobrist_key = key ^ ZOBRIST_CASTLING[self.castling_rights] ^ ZOBRIST_EN_PASSANT[self.en_passant_sq] ^ \
+            ZOBRIST_BLACK_TO_MOVE
+        self.white_to_move = not self.white_to_move
+
+    '''
+    Undoing last movement, the board and the bitboards come back with the same flips
+    '''
+    def undo_move(self):
+        if self.null_ply and self.null_ply == self.ply:
+            raise ValueError("The last move is a null move, it is taken back with undo_null_move")
+        if len(self.move_log) != 0:
+            move_id = self.move_log.pop()
+            board = self.board
+            bitboards = self.bitboards
+            occupancy = self.occupancy
+            start_sq = move_id & 63
+            end_sq = move_id >> 6 & 63
+            start = SQ120[start_sq]
+            end = SQ120[end_sq]
+            start_bit = 1 << start_sq
+            end_bit = 1 << end_sq
+            piece_placed = board[end]
+            ally_color = piece_placed & (WHITE | BLACK)
+            piece_moved = ally_color | PAWN if move_id >> PROMOTION_SHIFT else piece_placed
+            self.ply -= 1
+            record = self.undo_stack[self.ply]
+            piece_captured = record[UNDO_CAPTURED]
+            board[start] = piece_moved
+            bitboards[piece_moved] ^= start_bit
+            bitboards[piece_placed] ^= end_bit
+            occupancy[ally_color] ^= start_bit | end_bit
+            capture_sq = end
+            capture_bit = end_bit
+            if piece_moved == ally_color | PAWN and end == record[UNDO_EN_PASSANT]:
+                if ally_color == WHITE:
+                    capture_sq, capture_bit = end + 10, end_bit << 8
+                else:
+                    capture_sq, capture_bit = end - 10, end_bit >> 8
+                board[end] = EMPTY
+            board[capture_sq] = piece_captured
+            if piece_captured != EMPTY:
+                bitboards[piece_captured] ^= capture_bit
+                occupancy[piece_captured & (WHITE | BLACK)] ^= capture_bit
+            if piece_moved == ally_color | KING:
+                if ally_color == WHITE:
+                    self.white_king_location = start
+                else:
+                    self.black_king_location = start
+                if end - start == 2 or end - start == -2:
+                    rook_start, rook_end = CASTLE_ROOK[end]
+                    board[rook_start] = board[rook_end]
+                    board[rook_end] = EMPTY
+                    rook = 1 << SQ64[rook_start] | 1 << SQ64[rook_end]
+                    bitboards[ally_color | ROOK] ^= rook
+                    occupancy[ally_color] ^= rook
+            self.white_to_move = not self.white_to_move
+            self.halfmove_clock = record[UNDO_HALFMOVE]
+            self.castling_rights = record[UNDO_CASTLING]
+            self.en_passant_sq = record[UNDO_EN_PASSANT]
+            self.zobrist_key = record[UNDO_HASH]
+
+    '''
+    Same as GameState.is_insufficient_material, from the bitboards since the piece square sets are not kept
+    '''
+    def is_insufficient_material(self):
+        bitboards = self.bitboards
+        for color in (WHITE, BLACK):
+            if bitboards[color | PAWN] or bitboards[color | ROOK] or bitboards[color | QUEEN]:
+                return False
+        knights = bitboards[WHITE | KNIGHT] | bitboards[BLACK | KNIGHT]
+        bishops = bitboards[WHITE | BISHOP] | bitboards[BLACK | BISHOP]
+        if popcount(knights | bishops) <= 1:
+            return True
+        #only bishops, all of them on squares of one color
+        return not knights and (not bishops & LIGHT_SQUARES or not bishops & ~LIGHT_SQUARES)
+
+    '''
+    Same result as GameState.get_pins_and_checks but from the masks, since the king rays are not kept.
+    It also sets self.checkers and self.pinned, the null moves rely on it
+    '''
+    def get_pins_and_checks(self):
+        bitboards = self.bitboards
+        if self.white_to_move:
+            ally_color, enemy_color = WHITE, BLACK
+        else:
+            ally_color, enemy_color = BLACK, WHITE
+        ally = self.occupancy[ally_color]
+        occupied = ally | self.occupancy[enemy_color]
+        king_sq = bitboards[ally_color | KING].bit_length() - 1
+        self.checkers = self.attackers_to(king_sq, enemy_color, occupied)
+        self.get_pin_rays(king_sq, enemy_color, ally, occupied)
+        #pins and checks use mailbox squares and directions, like the king rays
+        king_ray_index = RAY_INDEX[SQ120[king_sq]]
+        pins = {}
+        pinned = self.pinned
+        while pinned:
+            bit = pinned & -pinned
+            pinned ^= bit
+            sq = SQ120[bit.bit_length() - 1]
+            pins[sq] = RAY_DIRECTIONS[king_ray_index[sq]]
+        checks = []
+        checkers = self.checkers
+        while checkers:
+            bit = checkers & -checkers
+            checkers ^= bit
+            sq = SQ120[bit.bit_length() - 1]
+            if bit & bitboards[enemy_color | KNIGHT]:
+                checks.append((sq, sq - SQ120[king_sq]))
+            else:
+                checks.append((sq, RAY_DIRECTIONS[king_ray_index[sq]]))
+        return self.checkers != 0, pins, checks
+
+    '''
+    Bitboard of the pieces of color that attack the square sq, with occupied as the blockers for the sliders
+    '''
+    def attackers_to(self, sq, color, occupied):
+        bitboards = self.bitboards
+        queens = bitboards[color | QUEEN]
+        return (KNIGHT_ATTACKS[sq] & bitboards[color | KNIGHT]) | \
+               (KING_ATTACKS[sq] & bitboards[color | KING]) | \
+               (PAWN_ATTACKS[color ^ (WHITE | BLACK)][sq] & bitboards[color | PAWN]) | \
+               (bishop_attacks(sq, occupied) & (bitboards[color | BISHOP] | queens)) | \
+               (rook_attacks(sq, occupied) & (bitboards[color | ROOK] | queens))
+
+    '''
+    Every square attacked by the pieces of color, with occupied as the blockers for the sliders
+    '''
+    def attack_map(self, color, occupied):
+        bitboards = self.bitboards
+        pawns = bitboards[color | PAWN]
+        if color == WHITE:
+            attacks = (pawns & ~FILE_A) >> 9 | (pawns & ~FILE_H) >> 7
+        else:
+            attacks = ((pawns & ~FILE_A) << 7 | (pawns & ~FILE_H) << 9) & FULL
+        attacks |= KING_ATTACKS[bitboards[color | KING].bit_length() - 1]
+        knights = bitboards[color | KNIGHT]
+        while knights:
+            bit = knights & -knights
+            knights ^= bit
+            attacks |= KNIGHT_ATTACKS[bit.bit_length() - 1]
+        queens = bitboards[color | QUEEN]
+        bishops = bitboards[color | BISHOP] | queens
+        while bishops:
+            bit = bishops & -bishops
+            bishops ^= bit
+            attacks |= bishop_attacks(bit.bit_length() - 1, occupied)
+        rooks = bitboards[color | ROOK] | queens
+        while rooks:
+            bit = rooks & -rooks
+            rooks ^= bit
+            attacks |= rook_attacks(bit.bit_length() - 1, occupied)
+        return attacks
+
+    '''
+    All moves considering checks and pins as packed moves, generated with masks instead of board scans.
+    gen and start_sq work like in GameState.generate_moves, they only narrow the masks
+    '''
+    def generate_moves(self, gen=GEN_ALL, start_sq=None):
+        moves = array('H')
+        bitboards = self.bitboards
+        if self.white_to_move:
+            ally_color, enemy_color = WHITE, BLACK
+        else:
+            ally_color, enemy_color = BLACK, WHITE
+        ally = self.occupancy[ally_color]
+        enemy = self.occupancy[enemy_color]
+        occupied = ally | enemy
+        king = bitboards[ally_color | KING]
+        king_sq = king.bit_length() - 1
+
+        self.checkers = self.attackers_to(king_sq, enemy_color, occupied)
+        self.in_check = self.checkers != 0
+        if self.debug:
+            assert self.bitboards_from_board() == (bitboards, self.occupancy), "bitboards are out of date"
+            assert self.zobrist_key == self.compute_zobrist_key(), "incremental zobrist key is out of date"
+        #squares the generated moves may end on
+        gen_targets = 0
+        if gen & GEN_CAPTURES:
+            gen_targets |= enemy
+        if gen & GEN_QUIETS:
+            gen_targets |= ~occupied
+        from_squares = -1 if start_sq is None else 1 << start_sq
+
+        #the king may not step onto attacked squares, the king itself must not block the sliders
+        targets = KING_ATTACKS[king_sq] & gen_targets if king & from_squares else 0
+        if targets:
+            self.add_targets(king_sq, targets & ~self.attack_map(enemy_color, occupied ^ king), moves)
+        if gen & GEN_QUIETS and self.castling_rights and not self.checkers and king & from_squares:
+            self.add_castle_moves(king_sq, ally_color, enemy_color, occupied, moves)
+
+        #double check, only the king can move
+        if self.checkers & (self.checkers - 1):
+            return moves
+
+        #squares the other pieces may move to
+        if self.checkers:
+            checker_sq = self.checkers.bit_length() - 1
+            check_mask = BETWEEN[king_sq][checker_sq] | self.checkers
+        else:
+            check_mask = FULL
+        allowed = check_mask & gen_targets
+
+        pin_rays = self.get_pin_rays(king_sq, enemy_color, ally, occupied)
+
+        empty = ~occupied
+        pawns = bitboards[ally_color | PAWN] & from_squares
+        if ally_color == WHITE:
+            step = -8
+            start_row = RANK_2
+        else:
+            step = 8
+            start_row = RANK_7
+        while pawns:
+            bit = pawns & -pawns
+            pawns ^= bit
+            sq = bit.bit_length() - 1
+            targets = PAWN_ATTACKS[ally_color][sq] & enemy
+            one = 1 << (sq + step)
+            if one & empty:
+                targets |= one
+                if bit & start_row:
+                    targets |= 1 << (sq + 2 * step) & empty
+            targets &= check_mask & pin_rays.get(sq, -1)
+            #promotions go with the captures whether they take something or not
+            if targets & LAST_RANKS:
+                if gen & GEN_CAPTURES:
+                    self.add_promotions(sq, targets, moves)
+            else:
+                self.add_targets(sq, targets & gen_targets, moves)
+        if gen & GEN_CAPTURES and self.en_passant_sq:
+            self.add_en_passant_moves(king_sq, ally_color, enemy_color, occupied, from_squares, moves)
+
+        knights = bitboards[ally_color | KNIGHT] & ~self.pinned & from_squares
+        while knights:
+            bit = knights & -knights
+            knights ^= bit
+            sq = bit.bit_length() - 1
+            self.add_targets(sq, KNIGHT_ATTACKS[sq] & allowed, moves)
+
+        queens = bitboards[ally_color | QUEEN] & from_squares
+        bishops = bitboards[ally_color | BISHOP] & from_squares | queens
+        while bishops:
+            bit = bishops & -bishops
+            bishops ^= bit
+            sq = bit.bit_length() - 1
+            self.add_targets(sq, bishop_attacks(sq, occupied) & allowed & pin_rays.get(sq, -1), moves)
+
+        rooks = bitboards[ally_color | ROOK] & from_squares | queens
+        while rooks:
+            bit = rooks & -rooks
+            rooks ^= bit
+            sq = bit.bit_length() - 1
+            self.add_targets(sq, rook_attacks(sq, occupied) & allowed & pin_rays.get(sq, -1), moves)
+        return moves
+
+    '''
+    Same checks as GameState.is_legal_id, from the masks: the target of the moving piece, the check mask
+    and the pin ray of the piece if it has one
+    '''
+    def is_legal_id(self, move_id):
+        bitboards = self.bitboards
+        start_sq = move_id & 63
+        end_sq = move_id >> 6 & 63
+        end = 1 << end_sq
+        piece_moved = self.board[SQ120[start_sq]]
+        if self.white_to_move:
+            ally_color, enemy_color = WHITE, BLACK
+        else:
+            ally_color, enemy_color = BLACK, WHITE
+        ally = self.occupancy[ally_color]
+        enemy = self.occupancy[enemy_color]
+        occupied = ally | enemy
+        if not piece_moved & ally_color or end & ally:
+            return False
+        type = piece_moved ^ ally_color
+        promotion = move_id >> PROMOTION_SHIFT
+        if promotion and not KNIGHT <= promotion <= QUEEN:
+            return False
+        king_sq = bitboards[ally_color | KING].bit_length() - 1
+        if type == PAWN:
+            if (end & LAST_RANKS != 0) != (promotion != 0):
+                return False
+            if SQ120[end_sq] == self.en_passant_sq and PAWN_ATTACKS[ally_color][start_sq] & end:
+                moves = array('H')
+                self.add_en_passant_moves(king_sq, ally_color, enemy_color, occupied, 1 << start_sq, moves)
+                return len(moves) != 0
+        elif promotion:
+            return False
+        if type == KING:
+            if end_sq - start_sq == 2 or end_sq - start_sq == -2:
+                if self.attackers_to(king_sq, enemy_color, occupied):
+                    return False
+                moves = array('H')
+                self.add_castle_moves(king_sq, ally_color, enemy_color, occupied, moves)
+                return move_id in moves
+            #the king leaves its square so it does not block the sliders
+            return KING_ATTACKS[start_sq] & end != 0 and \
+                not self.attackers_to(end_sq, enemy_color, occupied ^ (1 << start_sq))
+        self.checkers = self.attackers_to(king_sq, enemy_color, occupied)
+        self.in_check = self.checkers != 0
+        if self.checkers:
+            if self.checkers & (self.checkers - 1):
+                return False
+            if not (BETWEEN[king_sq][self.checkers.bit_length() - 1] | self.checkers) & end:
+                return False
+        pin_rays = self.get_pin_rays(king_sq, enemy_color, ally, occupied)
+        if not pin_rays.get(start_sq, -1) & end:
+            return False
+        if type == PAWN:
+            step = -8 if ally_color == WHITE else 8
+            if PAWN_ATTACKS[ally_color][start_sq] & end:
+                return end & enemy != 0
+            if occupied >> (start_sq + step) & 1:
+                return False
+            return end_sq == start_sq + step or (end_sq == start_sq + 2 * step and not end & occupied and
+                                                 (1 << start_sq) & (RANK_2 if ally_color == WHITE else RANK_7) != 0)
+        if type == KNIGHT:
+            targets = KNIGHT_ATTACKS[start_sq]
+        elif type == BISHOP:
+            targets = bishop_attacks(start_sq, occupied)
+        elif type == ROOK:
+            targets = rook_attacks(start_sq, occupied)
+        else:
+            targets = bishop_attacks(start_sq, occupied) | rook_attacks(start_sq, occupied)
+        return targets & end != 0
+
+    '''
+    Pins, an enemy slider seeing the king through exactly one allied piece.
+    Sets self.pinned and returns the squares each pinned piece may still move to, keyed by its square
+    '''
+    def get_pin_rays(self, king_sq, enemy_color, ally, occupied):
+        bitboards = self.bitboards
+        pin_rays = {}
+        enemy_queens = bitboards[enemy_color | QUEEN]
+        enemy = occupied & ~ally
+        snipers = (rook_attacks(king_sq, enemy) & (bitboards[enemy_color | ROOK] | enemy_queens)) | \
+                  (bishop_attacks(king_sq, enemy) & (bitboards[enemy_color | BISHOP] | enemy_queens))
+        self.pinned = 0
+        while snipers:
+            bit = snipers & -snipers
+            snipers ^= bit
+            sniper_sq = bit.bit_length() - 1
+            blockers = BETWEEN[king_sq][sniper_sq] & occupied
+            if blockers and not blockers & (blockers - 1) and blockers & ally:
+                self.pinned |= blockers
+                pin_rays[blockers.bit_length() - 1] = BETWEEN[king_sq][sniper_sq] | bit
+        return pin_rays
+
+    '''
+    Number of legal moves from the same masks as generate_moves, each piece adds the popcount of its targets.
+    Unpinned pawns are counted all at once with shifts
+    '''
+    def count_valid_moves(self):
+        bitboards = self.bitboards
+        if self.white_to_move:
+            ally_color, enemy_color = WHITE, BLACK
+        else:
+            ally_color, enemy_color = BLACK, WHITE
+        ally = self.occupancy[ally_color]
+        enemy = self.occupancy[enemy_color]
+        occupied = ally | enemy
+        empty = ~occupied & FULL
+        king = bitboards[ally_color | KING]
+        king_sq = king.bit_length() - 1
+
+        self.checkers = self.attackers_to(king_sq, enemy_color, occupied)
+        self.in_check = self.checkers != 0
+        count = 0
+        targets = KING_ATTACKS[king_sq] & ~ally
+        if targets:
+            count = popcount(targets & ~self.attack_map(enemy_color, occupied ^ king))
+        if self.checkers & (self.checkers - 1):
+            return count
+        if self.checkers:
+            checker_sq = self.checkers.bit_length() - 1
+            allowed = BETWEEN[king_sq][checker_sq] | self.checkers
+        else:
+            allowed = ~ally & FULL
+        pin_rays = self.get_pin_rays(king_sq, enemy_color, ally, occupied)
+        #the rare moves are generated, there are at most two of each
+        if self.en_passant_sq or (self.castling_rights and not self.checkers):
+            moves = array('H')
+            if self.en_passant_sq:
+                self.add_en_passant_moves(king_sq, ally_color, enemy_color, occupied, -1, moves)
+            if self.castling_rights and not self.checkers:
+                self.add_castle_moves(king_sq, ally_color, enemy_color, occupied, moves)
+            count += len(moves)
+
+        pawns = bitboards[ally_color | PAWN]
+        free_pawns = pawns & ~self.pinned
+        if ally_color == WHITE:
+            step = -8
+            one = free_pawns >> 8 & empty
+            two = (one & RANK_2 >> 8) >> 8 & empty
+            left = (free_pawns & ~FILE_A) >> 9 & enemy & allowed
+            right = (free_pawns & ~FILE_H) >> 7 & enemy & allowed
+        else:
+            step = 8
+            one = free_pawns << 8 & empty
+            two = (one & RANK_7 << 8) << 8 & empty
+            left = (free_pawns & ~FILE_A) << 7 & enemy & allowed
+            right = (free_pawns & ~FILE_H) << 9 & enemy & allowed
+        count += popcount(one & allowed) + popcount(two & allowed) + popcount(left) + popcount(right)
+        #each promotion is four moves
+        count += 3 * popcount((one | left | right) & allowed & LAST_RANKS)
+        pinned_pawns = pawns & self.pinned
+        while pinned_pawns:
+            bit = pinned_pawns & -pinned_pawns
+            pinned_pawns ^= bit
+            sq = bit.bit_length() - 1
+            targets = PAWN_ATTACKS[ally_color][sq] & enemy
+            one = 1 << (sq + step)
+            if one & empty:
+                targets |= one
+                if bit & (RANK_2 if ally_color == WHITE else RANK_7):
+                    targets |= 1 << (sq + 2 * step) & empty
+            targets &= allowed & pin_rays[sq]
+            count += popcount(targets) * (4 if targets & LAST_RANKS else 1)
+
+        knights = bitboards[ally_color | KNIGHT] & ~self.pinned
+        while knights:
+            bit = knights & -knights
+            knights ^= bit
+            count += popcount(KNIGHT_ATTACKS[bit.bit_length() - 1] & allowed)
+
+        queens = bitboards[ally_color | QUEEN]
+        bishops = bitboards[ally_color | BISHOP] | queens
+        while bishops:
+            bit = bishops & -bishops
+            bishops ^= bit
+            sq = bit.bit_length() - 1
+            count += popcount(bishop_attacks(sq, occupied) & allowed & pin_rays.get(sq, -1))
+        rooks = bitboards[ally_color | ROOK] | queens
+        while rooks:
+            bit = rooks & -rooks
+            rooks ^= bit
+            sq = bit.bit_length() - 1
+            count += popcount(rook_attacks(sq, occupied) & allowed & pin_rays.get(sq, -1))
+        return count
+
+    '''
+    En passant captures onto self.en_passant_sq by the pawns in from_squares. Each one is tried on the
+    occupancy, with both pawns gone from the row a slider can reach the king where no pin showed it
+    '''
+    def add_en_passant_moves(self, king_sq, ally_color, enemy_color, occupied, from_squares, moves):
+        end_sq = SQ64[self.en_passant_sq]
+        end = 1 << end_sq
+        capture = end << 8 if ally_color == WHITE else end >> 8
+        pawns = PAWN_ATTACKS[enemy_color][end_sq] & self.bitboards[ally_color | PAWN] & from_squares
+        while pawns:
+            bit = pawns & -pawns
+            pawns ^= bit
+            #the captured pawn is still in its bitboard, so it is taken out of the attackers
+            if not self.attackers_to(king_sq, enemy_color, occupied ^ bit ^ capture | end) & ~capture:
+                moves.append(bit.bit_length() - 1 | end_sq << 6)
+
+    '''
+    Castles of the side to move, the caller makes sure the king is not in check
+    '''
+    def add_castle_moves(self, king_sq, ally_color, enemy_color, occupied, moves):
+        for right, king_end, empty_mask, safe_squares in BB_CASTLES[ally_color]:
+            if self.castling_rights & right and not occupied & empty_mask:
+                for sq in safe_squares:
+                    if self.attackers_to(sq, enemy_color, occupied):
+                        break
+                else:
+                    moves.append(king_sq | king_end << 6)
+
+    def add_promotions(self, sq, targets, moves):
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            for flag in PROMOTION_FLAGS:
+                moves.append(sq | (bit.bit_length() - 1) << 6 | flag)
+
+    def add_targets(self, sq, targets, moves):
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            moves.append(sq | (bit.bit_length() - 1) << 6)
@@ -1,16 +1,198 @@
+import random
+import struct
+from array import array
+from collections import OrderedDict
+
+#pieces are stored as small integers, a color bit plus the type of piece
+#so piece & WHITE tests the color and piece & PIECE_TYPE gives the type
+EMPTY = 0
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = 1, 2, 3, 4, 5, 6
+PIECE_TYPE = 7
+WHITE = 8
+BLACK = 16
+#sentinel for the squares around the board
+OFFBOARD = 32
+PIECE_CODES = {"--": EMPTY}
+for color_name, color in (('w', WHITE), ('b', BLACK)):
+    for type_name, type_code in (('p', PAWN), ('N', KNIGHT), ('B', BISHOP), ('R', ROOK), ('Q', QUEEN), ('K', KING)):
+        PIECE_CODES[color_name + type_name] = color | type_code
+#two character names of the codes, they are the keys of ChessMain.IMAGES
+PIECE_NAMES = {v: k for k, v in PIECE_CODES.items()}
+
+#the board is a 10x12 mailbox, the 8x8 board sits in the middle surrounded by OFFBOARD squares
+#(two rows above and below so knights jumping off the board also land on a sentinel)
+#a square is a single integer and moving in a direction is adding an offset to it
+def mailbox_square(r, c):
+    return 21 + r * 10 + c
+
+BOARD_SQUARES = tuple(mailbox_square(r, c) for r in range(8) for c in range(8))
+#mailbox square to (row, col), None for the sentinels
+ROW_COL = [None] * 120
+for sq in BOARD_SQUARES:
+    ROW_COL[sq] = divmod(sq - 21, 10)
+
+#same order as before: up, left, down, right and then the diagonals
+DIRECTIONS = (-10, -1, 10, 1, -11, -9, 9, 11)
+KNIGHT_OFFSETS = (-21, -19, -12, -8, 19, 21, 8, 12)
+
+#leaper targets computed once: for every board square the squares a knight, a king or a pawn
+#of each color can reach, sentinels are already filtered out
+def _targets_table(offsets):
+    table = [()] * 120
+    for sq in BOARD_SQUARES:
+        table[sq] = tuple(sq + d for d in offsets if ROW_COL[sq + d] is not None)
+    return table
+
+KNIGHT_TARGETS = _targets_table(KNIGHT_OFFSETS)
+KING_TARGETS = _targets_table(DIRECTIONS)
+PAWN_CAPTURE_TARGETS = {WHITE: _targets_table((-11, -9)), BLACK: _targets_table((9, 11))}
+
+#directions of the sliding pieces, indexed by the type of piece
+SLIDER_DIRECTIONS = [(), (), (), DIRECTIONS[4:], DIRECTIONS[:4], DIRECTIONS, ()]
+
+#which moves the generators produce, the flags can be combined
+GEN_CAPTURES = 1
+GEN_QUIETS = 2
+GEN_ALL = GEN_CAPTURES | GEN_QUIETS
+#GEN_TARGETS[gen][color] has the piece codes a piece of color may move onto
+GEN_TARGETS = [None] * (GEN_ALL + 1)
+for gen in (GEN_CAPTURES, GEN_QUIETS, GEN_ALL):
+    GEN_TARGETS[gen] = {}
+    for color in (WHITE, BLACK):
+        enemy_color = color ^ (WHITE | BLACK)
+        codes = set()
+        if gen & GEN_QUIETS:
+            codes.add(EMPTY)
+        if gen & GEN_CAPTURES:
+            codes.update(enemy_color | type for type in (PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING))
+        GEN_TARGETS[gen][color] = frozenset(codes)
+#stages of iter_valid_moves, in the order the moves come out
+HASH_MOVE_STAGE, CAPTURE_STAGE, QUIET_STAGE = 0, 1, 2
+
+#RAY_INDEX[king_sq][sq] is the index in DIRECTIONS of the ray from king_sq that goes through sq, -1 if none
+RAY_INDEX = [None] * 120
+for sq in BOARD_SQUARES:
+    RAY_INDEX[sq] = [-1] * 120
+    for j, d in enumerate(DIRECTIONS):
+        end_sq = sq + d
+        while ROW_COL[end_sq] is not None:
+            RAY_INDEX[sq][end_sq] = j
+            end_sq += d
+#BETWEEN_SQUARES[sq][end_sq] has the squares strictly between two squares on the same line, () if not on one
+BETWEEN_SQUARES = [None] * 120
+for sq in BOARD_SQUARES:
+    BETWEEN_SQUARES[sq] = [()] * 120
+    for d in DIRECTIONS:
+        between = []
+        end_sq = sq + d
+        while ROW_COL[end_sq] is not None:
+            BETWEEN_SQUARES[sq][end_sq] = tuple(between)
+            between.append(end_sq)
+            end_sq += d
+
+
+#moves are packed in 16 bits: the start square in the low 6 bits, the end square in the next 6
+#and the top 4 bits are left for flags. These squares are row * 8 + col (0 is a8, 63 is h1)
+SQ64 = [0] * 120
+for i, sq in enumerate(BOARD_SQUARES):
+    SQ64[sq] = i
+SQ120 = BOARD_SQUARES
+#end square already shifted into place
+END_BITS = [i << 6 for i in SQ64]
+
+#a promotion keeps the type of the new piece in the flag bits, the other moves have no flags:
+#castling is the king moving two squares and en passant a pawn moving onto the en passant square
+PROMOTION_SHIFT = 12
+PROMOTION_FLAGS = tuple(type << PROMOTION_SHIFT for type in (QUEEN, ROOK, BISHOP, KNIGHT))
+
+#castling rights, one bit each
+WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE = 1, 2, 4, 8
+ALL_CASTLING = 15
+#the rights left after a move are rights & CASTLING_MASK[start] & CASTLING_MASK[end],
+#so moving the king or a rook, or capturing a rook, drops the right that needed them
+CASTLING_MASK = [ALL_CASTLING] * 120
+CASTLING_MASK[mailbox_square(7, 4)] = ALL_CASTLING ^ (WHITE_KINGSIDE | WHITE_QUEENSIDE)
+CASTLING_MASK[mailbox_square(7, 7)] = ALL_CASTLING ^ WHITE_KINGSIDE
+CASTLING_MASK[mailbox_square(7, 0)] = ALL_CASTLING ^ WHITE_QUEENSIDE
+CASTLING_MASK[mailbox_square(0, 4)] = ALL_CASTLING ^ (BLACK_KINGSIDE | BLACK_QUEENSIDE)
+CASTLING_MASK[mailbox_square(0, 7)] = ALL_CASTLING ^ BLACK_KINGSIDE
+CASTLING_MASK[mailbox_square(0, 0)] = ALL_CASTLING ^ BLACK_QUEENSIDE
+#for each side: (right, king end square, rook square, squares that must be empty,
+#squares the king goes through that must not be attacked)
+CASTLES = {}
+for color, r, kingside, queenside in ((WHITE, 7, WHITE_KINGSIDE, WHITE_QUEENSIDE),
+                                      (BLACK, 0, BLACK_KINGSIDE, BLACK_QUEENSIDE)):
+    CASTLES[color] = ((kingside, mailbox_square(r, 6), mailbox_square(r, 7),
+                       (mailbox_square(r, 5), mailbox_square(r, 6)), (mailbox_square(r, 5), mailbox_square(r, 6))),
+                      (queenside, mailbox_square(r, 2), mailbox_square(r, 0),
+                       (mailbox_square(r, 3), mailbox_square(r, 2), mailbox_square(r, 1)),
+                       (mailbox_square(r, 3), mailbox_square(r, 2))))
+#the rook move of a castle keyed by the end square of the king
+CASTLE_ROOK = {}
+for r in (0, 7):
+    CASTLE_ROOK[mailbox_square(r, 6)] = (mailbox_square(r, 7), mailbox_square(r, 5))
+    CASTLE_ROOK[mailbox_square(r, 2)] = (mailbox_square(r, 0), mailbox_square(r, 3))
+
+#zobrist keys, a random 64 bit number for every piece on every square, the side to move,
+#every set of castling rights and every en passant square. The key of a position is the xor of its numbers.
+#The seed is fixed so the keys are the same in every process
+_zobrist_random = random.Random(20240611)
+ZOBRIST_PIECES = [[0] * 120 for _ in range((BLACK | KING) + 1)]
+for piece in PIECE_NAMES:
+    if piece != EMPTY:
+        for sq in BOARD_SQUARES:
+            ZOBRIST_PIECES[piece][sq] = _zobrist_random.getrandbits(64)
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+ZOBRIST_CASTLING = [_zobrist_random.getrandbits(64) for _ in range(ALL_CASTLING + 1)]
+#no en passant square (0) has no number
+ZOBRIST_EN_PASSANT = [0] * 120
+for sq in BOARD_SQUARES:
+    ZOBRIST_EN_PASSANT[sq] = _zobrist_random.getrandbits(64)
+
+#fields of an undo record, what make_move overwrites and undo_move puts back.
+#UNDO_NULL_PLY is only written by make_null_move
+UNDO_CAPTURED, UNDO_WHITE_KING, UNDO_BLACK_KING, UNDO_HALFMOVE, UNDO_CASTLING, UNDO_EN_PASSANT, UNDO_HASH, \
+    UNDO_NULL_PLY = range(8)
+UNDO_SIZE = 8
+#records allocated up front, the stack doubles when a game gets longer
+UNDO_STACK_START = 256
+
+#GameState.snapshot: the 64 squares (a8 first) as piece codes, then white_to_move, castling_rights,
+#en_passant_sq (a mailbox square, 0 for none) and halfmove_clock
+SNAPSHOT = struct.Struct('<64s?BBH')
+#Position: the same fields without the counter, so it is also the start of a snapshot
+POSITION = struct.Struct('<64s?BB')
+
+
 class GameState():
 
     """
     Responsable of storing all the information about the current state of a chess game.
     It's also responsible for determining if a move is valid or not.
     It must have a move log.
+    The backend argument selects how the position is stored, None keeps the mailbox board and
+    "bitboard" uses BitboardEngine.BitboardGameState. Both share make_move, undo_move,
+    get_valid_moves and the Move objects.
     """
-    def __init__(self):
-        #board is an 8x8 dimensional list which has 2 characters
+    #when True generate_moves cross checks the incremental state against a full recomputation: the pins,
+    #checks and zobrist key, and on the bitboard backend the zobrist key and the bitboards
+    debug = False
+
+    def __new__(cls, backend=None):
+        if cls is GameState and backend == "bitboard":
+            #imported here because BitboardEngine builds on this module
+            from BitboardEngine import BitboardGameState
+            cls = BitboardGameState
+        elif backend not in (None, "bitboard"):
+            raise ValueError("Unknown GameState backend: {}".format(backend))
+        return super().__new__(cls)
+
+    def __init__(self, backend=None):
+        #start_board is an 8x8 dimensional list which has 2 characters
         #first character is the side of the board white and black
         #second character has the type of piece: 'Q','K','B','N','R','p'
         #"--" represents blank spaces
-        self.board = [
+        start_board = [
             ["bR","bN","bB","bQ","bK","bB","bN","bR"],
             ["bp","bp","bp","bp","bp","bp","bp","bp"],
             ["--","--","--","--","--","--","--","--"],
@@ -19,339 +201,1115 @@ class GameState():
             ["--","--","--","--","--","--","--","--"],
             ["wp","wp","wp","wp","wp","wp","wp","wp"],
             ["wR","wN","wB","wQ","wK","wB","wN","wR"]]
-        self.move_functions = {'p': self.get_pawn_moves,'R':self.get_rook_moves,'N':self.get_knight_moves,
-                               'B':self.get_bishop_moves,'Q':self.get_queen_moves,'K':self.get_king_moves}
+        #board is the flat 10x12 mailbox with the piece codes
+        self.board = bytearray([OFFBOARD]) * 120
+        #squares of the pieces of each side, kept up to date by make_move and undo_move
+        #so the move generation only visits the pieces that exist
+        self.piece_squares = {WHITE: set(), BLACK: set()}
+        #indexed by the type of piece
+        self.move_functions = [None, self.get_pawn_moves, self.get_knight_moves, self.get_bishop_moves,
+                               self.get_rook_moves, self.get_queen_moves, self.get_king_moves]
+        #one undo record per move made, the records are reused so making a move allocates nothing
+        self.undo_stack = [[0] * UNDO_SIZE for _ in range(UNDO_STACK_START)]
+        #what each of the 8 rays out of each king holds: the square of a pinned piece,
+        #minus the square of a checking slider or 0, see scan_king_ray
+        self.king_rays = {WHITE: [0] * 8, BLACK: [0] * 8}
+        #optional MoveCache for get_valid_move_ids, off unless one is assigned here
+        self.move_cache = None
+        #the rest depends on the position
+        self.set_position(bytes(PIECE_CODES[name] for row in start_board for name in row), True, ALL_CASTLING, 0, 0)
 
-        self.white_to_move = True
-        self.move_log = []
-        self.white_king_location = (7,4)
-        self.black_king_location = (0,4)
+    '''
+    Puts a position on the board and resets everything that depends on it, the move log included.
+    squares are the 64 piece codes from a8 to h1 and en_passant_sq a mailbox square (0 for none)
+    '''
+    def set_position(self, squares, white_to_move, castling_rights, en_passant_sq, halfmove_clock):
+        board = self.board
+        self.piece_squares[WHITE].clear()
+        self.piece_squares[BLACK].clear()
+        for sq, piece in zip(BOARD_SQUARES, squares):
+            board[sq] = piece
+            if piece != EMPTY:
+                self.piece_squares[piece & (WHITE | BLACK)].add(sq)
+                #king locations are mailbox squares
+                if piece == WHITE | KING:
+                    self.white_king_location = sq
+                elif piece == BLACK | KING:
+                    self.black_king_location = sq
+        self.white_to_move = white_to_move
+        #packed moves
+        self.move_log = array('H')
+        #number of undo records in use
+        self.ply = 0
+        #ply right after the last null move still on the stack (0 for none), is_repetition stops there
+        self.null_ply = 0
+        #moves since the last capture or pawn move
+        self.halfmove_clock = halfmove_clock
+        #castling rights still available (WHITE_KINGSIDE...) and the square behind a pawn that just moved two
+        #squares, only set when an enemy pawn stands next to it. Both are updated by make_move and undo_move
+        self.castling_rights = castling_rights
+        self.en_passant_sq = en_passant_sq
         #naive approcach
         # self.check_mate = False
         # self.stale_mate = False
         #advanced approach
         self.in_check = False
-        self.pins = []
+        #pins maps the pinned square to the direction of the pin
+        self.pins = {}
         self.checks = []
+        self.scan_king_rays(self.white_king_location)
+        self.scan_king_rays(self.black_king_location)
+        #64 bit zobrist key of the position, make_move and undo_move keep it up to date
+        self.zobrist_key = self.compute_zobrist_key()
+
+    '''
+    Zobrist key of the position computed from scratch, the incremental one must always be equal to it
+    '''
+    def compute_zobrist_key(self):
+        board = self.board
+        key = 0
+        for sq in BOARD_SQUARES:
+            if board[sq] != EMPTY:
+                key ^= ZOBRIST_PIECES[board[sq]][sq]
+        if not self.white_to_move:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        return key ^ ZOBRIST_CASTLING[self.castling_rights] ^ ZOBRIST_EN_PASSANT[self.en_passant_sq]
+
+    '''
+    The position as a small immutable bytes object (see SNAPSHOT), cheap to pickle and send to another process.
+    The move log is not part of it
+    '''
+    def snapshot(self):
+        board = self.board
+        squares = b''.join([board[sq:sq + 8] for sq in BOARD_SQUARES[::8]])
+        return SNAPSHOT.pack(squares, self.white_to_move, self.castling_rights, self.en_passant_sq,
+                             self.halfmove_clock)
+
+    '''
+    A new GameState with the position of a snapshot, backend works like in GameState()
+    '''
+    @classmethod
+    def from_snapshot(cls, snapshot, backend=None):
+        gs = cls(backend)
+        gs.load_snapshot(snapshot)
+        return gs
+
+    '''
+    Puts the position of a snapshot on this GameState, so a worker can reuse one GameState for many positions
+    '''
+    def load_snapshot(self, snapshot):
+        self.set_position(*SNAPSHOT.unpack(snapshot))
+
+    '''
+    A new GameState with the position of a FEN string, backend works like in GameState()
+    '''
+    @classmethod
+    def from_fen(cls, fen, backend=None):
+        gs = cls(backend)
+        gs.load_fen(fen)
+        return gs
+
+    '''
+    Puts the position of a FEN string on this GameState. The fullmove number is not kept, the en passant
+    square is dropped when no pawn can take there, like make_move does, and so is a castling right whose
+    king or rook is not on its home square. Raises ValueError for malformed input, a side without one king
+    or an en passant square that no pawn move could have left
+    '''
+    def load_fen(self, fen):
+        fields = fen.split()
+        if len(fields) < 4 or fields[1] not in ('w', 'b'):
+            raise ValueError("Invalid FEN: {}".format(fen))
+        squares = bytearray()
+        rows = fields[0].split('/')
+        if len(rows) != 8:
+            raise ValueError("Invalid FEN: {}".format(fen))
+        for i, row in enumerate(rows):
+            for char in row:
+                if char in '12345678':
+                    squares.extend(bytes(int(char)))
+                else:
+                    #the piece names use 'p' for pawns and upper case for the rest
+                    name = ('w' if char.isupper() else 'b') + (char.upper() if char not in 'pP' else 'p')
+                    if name not in PIECE_CODES:
+                        raise ValueError("Invalid FEN: {}".format(fen))
+                    squares.append(PIECE_CODES[name])
+            #every row has to fill exactly 8 squares, or the next rows would be shifted
+            if len(squares) != 8 * (i + 1):
+                raise ValueError("Invalid FEN: {}".format(fen))
+        #the move generation needs exactly one king of each side
+        if squares.count(WHITE | KING) != 1 or squares.count(BLACK | KING) != 1:
+            raise ValueError("Invalid FEN, each side needs one king: {}".format(fen))
+        white_to_move = fields[1] == 'w'
+        castling_rights = 0
+        for char, right in (('K', WHITE_KINGSIDE), ('Q', WHITE_QUEENSIDE), ('k', BLACK_KINGSIDE),
+                            ('q', BLACK_QUEENSIDE)):
+            if char in fields[2]:
+                castling_rights |= right
+        #a right only stays when its king and rook are on their home squares, some FENs have it anyway
+        for row, color in ((7, WHITE), (0, BLACK)):
+            for col, type in ((4, KING), (7, ROOK), (0, ROOK)):
+                if squares[row * 8 + col] != color | type:
+                    castling_rights &= CASTLING_MASK[mailbox_square(row, col)]
+        en_passant_sq = 0
+        if fields[3] != '-':
+            try:
+                row = Move.ranks_to_rows[fields[3][1]]
+                col = Move.files_to_cols[fields[3][0]]
+            except (KeyError, IndexError):
+                raise ValueError("Invalid FEN: {}".format(fen))
+            #the square is behind an enemy pawn that just moved two squares: on the 6th rank with white
+            #to move and the 3rd with black, with that pawn one row further
+            pawn_row = row + 1 if white_to_move else row - 1
+            ally_pawn = (WHITE if white_to_move else BLACK) | PAWN
+            enemy_pawn = (BLACK if white_to_move else WHITE) | PAWN
+            if len(fields[3]) != 2 or row != (2 if white_to_move else 5) or squares[pawn_row * 8 + col] != enemy_pawn:
+                raise ValueError("Invalid FEN, impossible en passant square: {}".format(fen))
+            #the pawns that can take are next to it
+            if any(0 <= c < 8 and squares[pawn_row * 8 + c] == ally_pawn for c in (col - 1, col + 1)):
+                en_passant_sq = mailbox_square(row, col)
+        halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+        self.set_position(bytes(squares), white_to_move, castling_rights, en_passant_sq, halfmove_clock)
 
     '''
-    Takes a move as a parameter and executes it (does not work for castling, promotion or en-passant)
+    The current position as an immutable, hashable Position
+    '''
+    def position(self):
+        return Position(self.snapshot()[:POSITION.size])
+
+    '''
+    Puts a Position on this GameState, the halfmove clock starts at 0
+    '''
+    def load_position(self, position):
+        self.set_position(*POSITION.unpack(position), 0)
+
+    '''
+    Takes a move as a parameter and executes it, castling, promotion and en-passant included
     '''
     def make_move(self, move):
-        self.board[move.start_row][move.start_col] = "--"
-        self.board[move.end_row][move.end_col] = move.piece_moved
-        self.move_log.append(move)
+        self.make_move_id(move.move_id)
+
+    '''
+    Same as make_move but with the packed move, this is what the search uses
+    '''
+    def make_move_id(self, move_id):
+        board = self.board
+        start = SQ120[move_id & 63]
+        end = SQ120[move_id >> 6 & 63]
+        piece_moved = board[start]
+        piece_captured = board[end]
+        ally_color = piece_moved & (WHITE | BLACK)
+        type = piece_moved & PIECE_TYPE
+        if self.ply == len(self.undo_stack):
+            self.undo_stack.extend([0] * UNDO_SIZE for _ in range(self.ply))
+        record = self.undo_stack[self.ply]
+        self.ply += 1
+        record[UNDO_WHITE_KING] = self.white_king_location
+        record[UNDO_BLACK_KING] = self.black_king_location
+        record[UNDO_HALFMOVE] = self.halfmove_clock
+        record[UNDO_CASTLING] = self.castling_rights
+        record[UNDO_EN_PASSANT] = self.en_passant_sq
+        record[UNDO_HASH] = key = self.zobrist_key
+        capture_sq = end
+        if type == PAWN:
+            self.halfmove_clock = 0
+            if end == self.en_passant_sq:
+                #en passant, the captured pawn is next to the start square
+                capture_sq = end + (10 if ally_color == WHITE else -10)
+                piece_captured = board[capture_sq]
+                board[capture_sq] = EMPTY
+        elif piece_captured != EMPTY:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        record[UNDO_CAPTURED] = piece_captured
+        board[start] = EMPTY
+        piece_placed = ally_color | move_id >> PROMOTION_SHIFT if move_id >> PROMOTION_SHIFT else piece_moved
+        board[end] = piece_placed
+        key ^= ZOBRIST_PIECES[piece_moved][start] ^ ZOBRIST_PIECES[piece_placed][end]
+        self.move_log.append(move_id)
+        ally_squares = self.piece_squares[ally_color]
+        ally_squares.remove(start)
+        ally_squares.add(end)
+        if piece_captured != EMPTY:
+            self.piece_squares[piece_captured & (WHITE | BLACK)].remove(capture_sq)
+            key ^= ZOBRIST_PIECES[piece_captured][capture_sq]
+        #castling, the king moves two squares and the rook jumps over it
+        rook_start = 0
+        if type == KING and (end - start == 2 or end - start == -2):
+            rook_start, rook_end = CASTLE_ROOK[end]
+            board[rook_end] = board[rook_start]
+            board[rook_start] = EMPTY
+            ally_squares.remove(rook_start)
+            ally_squares.add(rook_end)
+            key ^= ZOBRIST_PIECES[ally_color | ROOK][rook_start] ^ ZOBRIST_PIECES[ally_color | ROOK][rook_end]
+        key ^= ZOBRIST_CASTLING[self.castling_rights] ^ ZOBRIST_EN_PASSANT[self.en_passant_sq]
+        self.castling_rights &= CASTLING_MASK[start] & CASTLING_MASK[end]
+        self.en_passant_sq = 0
+        if type == PAWN and (end - start == 20 or end - start == -20):
+            enemy_pawn = (ally_color ^ (WHITE | BLACK)) | PAWN
+            if board[end - 1] == enemy_pawn or board[end + 1] == enemy_pawn:
+                self.en_passant_sq = (start + end) // 2
+        self.zobrist_key = key ^ ZOBRIST_CASTLING[self.castling_rights] ^ ZOBRIST_EN_PASSANT[self.en_passant_sq] ^ \
+            ZOBRIST_BLACK_TO_MOVE
         #swap players
         self.white_to_move = not self.white_to_move
         #updating the piece location
-        if move.piece_moved == 'wK':
-            self.white_king_location = (move.end_row,move.end_col)
-        elif move.piece_moved == 'bK':
-            self.black_king_location = (move.end_row,move.end_col)
+        if piece_moved == WHITE | KING:
+            self.white_king_location = end
+        elif piece_moved == BLACK | KING:
+            self.black_king_location = end
+        self.update_king_rays(start, end, piece_moved)
+        if capture_sq != end:
+            self.update_king_rays(capture_sq, capture_sq, EMPTY)
+        if rook_start:
+            self.update_king_rays(rook_start, rook_end, ally_color | ROOK)
 
 
     '''
-    Undoing last movement
+    Undoing last movement, everything make_move changed comes back from the undo record
     '''
     def undo_move(self):
+        if self.null_ply and self.null_ply == self.ply:
+            raise ValueError("The last move is a null move, it is taken back with undo_null_move")
         # a move is necessary to execute this
         if len(self.move_log) != 0:
-            move = self.move_log.pop()
-            self.board[move.start_row][move.start_col] = move.piece_moved
-            self.board[move.end_row][move.end_col] = move.piece_captured
+            move_id = self.move_log.pop()
+            board = self.board
+            start = SQ120[move_id & 63]
+            end = SQ120[move_id >> 6 & 63]
+            piece_moved = board[end]
+            ally_color = piece_moved & (WHITE | BLACK)
+            if move_id >> PROMOTION_SHIFT:
+                piece_moved = ally_color | PAWN
+            type = piece_moved & PIECE_TYPE
+            self.ply -= 1
+            record = self.undo_stack[self.ply]
+            piece_captured = record[UNDO_CAPTURED]
+            board[start] = piece_moved
+            capture_sq = end
+            if type == PAWN and end == record[UNDO_EN_PASSANT]:
+                capture_sq = end + (10 if ally_color == WHITE else -10)
+                board[end] = EMPTY
+            board[capture_sq] = piece_captured
+            ally_squares = self.piece_squares[ally_color]
+            ally_squares.remove(end)
+            ally_squares.add(start)
+            if piece_captured != EMPTY:
+                self.piece_squares[piece_captured & (WHITE | BLACK)].add(capture_sq)
+            rook_start = 0
+            if type == KING and (end - start == 2 or end - start == -2):
+                rook_start, rook_end = CASTLE_ROOK[end]
+                board[rook_start] = board[rook_end]
+                board[rook_end] = EMPTY
+                ally_squares.remove(rook_end)
+                ally_squares.add(rook_start)
             #switch players
             self.white_to_move = not self.white_to_move
+            self.white_king_location = record[UNDO_WHITE_KING]
+            self.black_king_location = record[UNDO_BLACK_KING]
+            self.halfmove_clock = record[UNDO_HALFMOVE]
+            self.castling_rights = record[UNDO_CASTLING]
+            self.en_passant_sq = record[UNDO_EN_PASSANT]
+            self.zobrist_key = record[UNDO_HASH]
+            self.update_king_rays(start, end, piece_moved)
+            if capture_sq != end:
+                self.update_king_rays(capture_sq, capture_sq, EMPTY)
+            if rook_start:
+                self.update_king_rays(rook_start, rook_end, ally_color | ROOK)
 
     '''
-    All moves considering checks see naive approach for a simpler explanation. This one is an advanced one
+    Passes the turn without moving a piece, for null move pruning. Raises ValueError when in check.
+    The null move is not added to move_log, it has to be taken back with undo_null_move before
+    undo_move is used again
+    '''
+    def make_null_move(self):
+        if self.get_pins_and_checks()[0]:
+            raise ValueError("A null move is not allowed in check")
+        if self.ply == len(self.undo_stack):
+            self.undo_stack.extend([0] * UNDO_SIZE for _ in range(self.ply))
+        record = self.undo_stack[self.ply]
+        self.ply += 1
+        record[UNDO_HALFMOVE] = self.halfmove_clock
+        record[UNDO_EN_PASSANT] = self.en_passant_sq
+        record[UNDO_HASH] = self.zobrist_key
+        record[UNDO_NULL_PLY] = self.null_ply
+        self.null_ply = self.ply
+        self.zobrist_key ^= ZOBRIST_EN_PASSANT[self.en_passant_sq] ^ ZOBRIST_BLACK_TO_MOVE
+        self.halfmove_clock += 1
+        self.en_passant_sq = 0
+        self.white_to_move = not self.white_to_move
+        #the board did not change so the king rays are still good, the side that passed was not in check
+        #so the side to move cannot be in check either
+        self.in_check, self.pins, self.checks = self.get_pins_and_checks()
+
+    def undo_null_move(self):
+        #only the last record can be taken back and it has to be a null move
+        if not self.null_ply or self.null_ply != self.ply:
+            raise ValueError("The last move is not a null move")
+        self.ply -= 1
+        record = self.undo_stack[self.ply]
+        self.halfmove_clock = record[UNDO_HALFMOVE]
+        self.en_passant_sq = record[UNDO_EN_PASSANT]
+        self.zobrist_key = record[UNDO_HASH]
+        self.null_ply = record[UNDO_NULL_PLY]
+        self.white_to_move = not self.white_to_move
+        self.in_check, self.pins, self.checks = self.get_pins_and_checks()
+
+    '''
+    True if the current position has been on the board times times, counting this one (3 is the
+    threefold repetition draw, a search can use 2). The keys of the earlier positions are in the undo records
+    and only the positions since the last capture or pawn move can be the same, the side to move too.
+    The scan also stops at the last null move, a position reached by passing is not a repetition
+    '''
+    def is_repetition(self, times=3):
+        key = self.zobrist_key
+        undo_stack = self.undo_stack
+        seen = 1
+        for ply in range(self.ply - 2, max(self.ply - self.halfmove_clock, self.null_ply) - 1, -2):
+            if undo_stack[ply][UNDO_HASH] == key:
+                seen += 1
+                if seen >= times:
+                    return True
+        return False
+
+    '''
+    True after 50 moves of each side without a capture or a pawn move
+    '''
+    def is_fifty_move_draw(self):
+        return self.halfmove_clock >= 100
+
+    '''
+    True if neither side can ever checkmate: only kings, plus a single knight or bishop,
+    or bishops that are all on squares of the same color. It stops at the first pawn, rook or queen
+    '''
+    def is_insufficient_material(self):
+        board = self.board
+        minors = 0
+        bishop_colors = 0
+        for color in (WHITE, BLACK):
+            for sq in self.piece_squares[color]:
+                type = board[sq] & PIECE_TYPE
+                if type == KING:
+                    continue
+                if type != KNIGHT and type != BISHOP:
+                    return False
+                minors += 1
+                if type == BISHOP:
+                    row, col = ROW_COL[sq]
+                    bishop_colors |= 1 << ((row + col) & 1)
+                else:
+                    bishop_colors = 3
+        return minors <= 1 or bishop_colors != 3
+
+    '''
+    Only the rays of a king that go through a square that changed can change, so after a move (or taking it back)
+    those are scanned again. When the king itself moved all its rays are scanned
+    '''
+    def update_king_rays(self, start, end, piece_moved):
+        for king_sq in (self.white_king_location, self.black_king_location):
+            if piece_moved & PIECE_TYPE == KING and (king_sq == start or king_sq == end):
+                self.scan_king_rays(king_sq)
+            else:
+                ray_index = RAY_INDEX[king_sq]
+                j = ray_index[start]
+                if j >= 0:
+                    self.scan_king_ray(king_sq, j)
+                j = ray_index[end]
+                if j >= 0:
+                    self.scan_king_ray(king_sq, j)
+
+    def scan_king_rays(self, king_sq):
+        for j in range(len(DIRECTIONS)):
+            self.scan_king_ray(king_sq, j)
+
+    '''
+    Walks the ray j out of the king on king_sq, same rules as checks_for_pins_and_checks
+    '''
+    def scan_king_ray(self, king_sq, j):
+        board = self.board
+        ally_color = board[king_sq] & (WHITE | BLACK)
+        d = DIRECTIONS[j]
+        pinned_sq = 0
+        result = 0
+        end_sq = king_sq + d
+        end_piece = board[end_sq]
+        while end_piece != OFFBOARD:
+            if end_piece & ally_color:
+                if pinned_sq:
+                    break
+                pinned_sq = end_sq
+            elif end_piece != EMPTY:
+                type = end_piece & PIECE_TYPE
+                if type == QUEEN or type == (ROOK if j <= 3 else BISHOP) or \
+                        (type == KING and end_sq == king_sq + d):
+                    result = pinned_sq if pinned_sq else -end_sq
+                break
+            end_sq += d
+            end_piece = board[end_sq]
+        self.king_rays[ally_color][j] = result
+
+    '''
+    Pins and checks of the side to move from the incremental king rays, plus the knight and pawn checks
+    which only need a few table lookups
+    '''
+    def get_pins_and_checks(self):
+        pins = {}
+        checks = []
+        if self.white_to_move:
+            ally_color, enemy_color = WHITE, BLACK
+            king_sq = self.white_king_location
+        else:
+            ally_color, enemy_color = BLACK, WHITE
+            king_sq = self.black_king_location
+        king_rays = self.king_rays[ally_color]
+        for j in range(len(DIRECTIONS)):
+            result = king_rays[j]
+            if result > 0:
+                pins[result] = DIRECTIONS[j]
+            elif result < 0:
+                checks.append((-result, DIRECTIONS[j]))
+        board = self.board
+        enemy_knight = enemy_color | KNIGHT
+        for end_sq in KNIGHT_TARGETS[king_sq]:
+            if board[end_sq] == enemy_knight:
+                checks.append((end_sq, end_sq - king_sq))
+        enemy_pawn = enemy_color | PAWN
+        for end_sq in PAWN_CAPTURE_TARGETS[ally_color][king_sq]:
+            if board[end_sq] == enemy_pawn:
+                checks.append((end_sq, end_sq - king_sq))
+        return len(checks) != 0, pins, checks
+
+    '''
+    All valid moves as Move objects, for the UI and the notation
     '''
     def get_valid_moves(self):
-        moves = []
-        self.in_check, self.pins, self.checks = self.checks_for_pins_and_checks()
+        from_move_id = Move.from_move_id
+        return [from_move_id(move_id) for move_id in self.get_valid_move_ids()]
+
+    '''
+    All valid moves packed in an array('H'), no Move objects are built.
+    With a move_cache they come from the cache when the position was seen before, as a read only
+    memoryview of the packed moves. in_check, pins and checks are refreshed on a cache hit as well
+    '''
+    def get_valid_move_ids(self):
+        move_cache = self.move_cache
+        if move_cache is None:
+            return self.generate_moves(GEN_ALL)
+        moves = move_cache.get(self.zobrist_key)
+        if moves is None:
+            moves = self.generate_moves(GEN_ALL).tobytes()
+            move_cache.put(self.zobrist_key, moves)
+        else:
+            #cheap, it reads the incremental king rays (the masks on the bitboard backend)
+            self.in_check, self.pins, self.checks = self.get_pins_and_checks()
+        return memoryview(moves).cast('H')
+
+    '''
+    Only the valid captures, straight from the generators without the quiet moves. For quiescence and tactics
+    '''
+    def get_capture_move_ids(self):
+        return self.generate_moves(GEN_CAPTURES)
+
+    '''
+    Same as get_capture_move_ids but as Move objects
+    '''
+    def get_capture_moves(self):
+        from_move_id = Move.from_move_id
+        return [from_move_id(move_id) for move_id in self.get_capture_move_ids()]
+
+    '''
+    Yields the valid packed moves in stages: first the hash move (if it is valid), then the captures and last
+    the quiet moves. A stage is only generated when the previous one has been consumed, so a search that
+    cuts off early never pays for the quiet moves. stage is the first stage to yield.
+    The position may be changed between yields as long as it is restored before asking for the next move
+    '''
+    def iter_valid_moves(self, hash_move=None, stage=HASH_MOVE_STAGE):
+        if stage <= HASH_MOVE_STAGE and hash_move is not None:
+            if self.is_legal_id(hash_move):
+                yield hash_move
+            else:
+                hash_move = None
+        else:
+            hash_move = None
+        if stage <= CAPTURE_STAGE:
+            for move_id in self.get_capture_move_ids():
+                if move_id != hash_move:
+                    yield move_id
+        if stage <= QUIET_STAGE:
+            for move_id in self.generate_moves(GEN_QUIETS):
+                if move_id != hash_move:
+                    yield move_id
+
+    '''
+    True if move is one of the valid moves, checked on its own without generating the others
+    '''
+    def is_legal(self, move):
+        return self.is_legal_id(move.move_id)
+
+    '''
+    Same as is_legal but with the packed move. Only the rules of the piece that moves are checked,
+    plus the pins and checks of the side to move
+    '''
+    def is_legal_id(self, move_id):
+        board = self.board
+        start = SQ120[move_id & 63]
+        end = SQ120[move_id >> 6 & 63]
+        piece_moved = board[start]
         if self.white_to_move:
-            king_row = self.white_king_location[0]
-            king_col = self.white_king_location[1]
+            ally_color, enemy_color = WHITE, BLACK
+            king_sq = self.white_king_location
         else:
-            king_row = self.black_king_location[0]
-            king_col = self.black_king_location[1]
+            ally_color, enemy_color = BLACK, WHITE
+            king_sq = self.black_king_location
+        if not piece_moved & ally_color or board[end] not in GEN_TARGETS[GEN_ALL][ally_color]:
+            return False
+        type = piece_moved & PIECE_TYPE
+        promotion = move_id >> PROMOTION_SHIFT
+        #the flag can only be one of the pieces a pawn becomes
+        if promotion and not KNIGHT <= promotion <= QUEEN:
+            return False
+        if type == PAWN:
+            #a pawn reaching the last row has to say what it becomes
+            if (ROW_COL[end][0] in (0, 7)) != (promotion != 0):
+                return False
+            if end == self.en_passant_sq and end in PAWN_CAPTURE_TARGETS[ally_color][start]:
+                return self.is_en_passant_legal(start, end)
+        elif promotion:
+            return False
+        if type == KING:
+            if end - start == 2 or end - start == -2:
+                for castle in CASTLES[ally_color]:
+                    if castle[1] == end:
+                        return start == king_sq and self.can_castle(castle, enemy_color)
+                return False
+            return end in KING_TARGETS[start] and not self.is_square_attacked(end, enemy_color, start)
+        self.in_check, self.pins, self.checks = self.get_pins_and_checks()
+        if len(self.checks) > 1 or (self.in_check and end not in self.get_block_squares(king_sq)):
+            return False
+        #direction of the move, pinned pieces can only move along the pin
+        j = RAY_INDEX[start][end]
+        pin_direction = self.pins.get(start)
+        if pin_direction is not None and (j < 0 or DIRECTIONS[j] != pin_direction and DIRECTIONS[j] != -pin_direction):
+            return False
+        if type == PAWN:
+            forward = -10 if ally_color == WHITE else 10
+            if end in PAWN_CAPTURE_TARGETS[ally_color][start]:
+                return board[end] != EMPTY
+            if board[start + forward] != EMPTY:
+                return False
+            return end == start + forward or \
+                (end == start + 2 * forward and board[end] == EMPTY and ROW_COL[start][0] == (6 if ally_color == WHITE else 1))
+        if type == KNIGHT:
+            return end in KNIGHT_TARGETS[start]
+        if j < 0 or DIRECTIONS[j] not in SLIDER_DIRECTIONS[type]:
+            return False
+        #nothing in between
+        d = DIRECTIONS[j]
+        sq = start + d
+        while sq != end:
+            if board[sq] != EMPTY:
+                return False
+            sq += d
+        return True
+
+    '''
+    True if a piece of color attacks the mailbox square sq. ignore_sq is treated as empty, it is the king
+    that moves so it does not hide the squares behind it
+    '''
+    def is_square_attacked(self, sq, color, ignore_sq=None):
+        board = self.board
+        for end_sq in KNIGHT_TARGETS[sq]:
+            if board[end_sq] == color | KNIGHT:
+                return True
+        for end_sq in KING_TARGETS[sq]:
+            if board[end_sq] == color | KING:
+                return True
+        #the pawns of color attacking sq sit where a pawn of the other color on sq would capture
+        for end_sq in PAWN_CAPTURE_TARGETS[color ^ (WHITE | BLACK)][sq]:
+            if board[end_sq] == color | PAWN:
+                return True
+        for j, d in enumerate(DIRECTIONS):
+            end_sq = sq + d
+            end_piece = board[end_sq]
+            while end_piece == EMPTY or end_sq == ignore_sq:
+                end_sq += d
+                end_piece = board[end_sq]
+            if end_piece & color:
+                type = end_piece & PIECE_TYPE
+                if type == QUEEN or type == (ROOK if j <= 3 else BISHOP):
+                    return True
+        return False
+
+    '''
+    True if the pawn on sq can take en passant on end_sq without leaving its king in check. The move is tried
+    on the board, it is rare enough and the two pawns leaving the same row can uncover a check no pin covers
+    '''
+    def is_en_passant_legal(self, sq, end_sq):
+        board = self.board
+        if self.white_to_move:
+            capture_sq = end_sq + 10
+            king_sq, enemy_color = self.white_king_location, BLACK
+        else:
+            capture_sq = end_sq - 10
+            king_sq, enemy_color = self.black_king_location, WHITE
+        pawn = board[sq]
+        captured = board[capture_sq]
+        board[sq] = EMPTY
+        board[capture_sq] = EMPTY
+        board[end_sq] = pawn
+        attacked = self.is_square_attacked(king_sq, enemy_color)
+        board[sq] = pawn
+        board[capture_sq] = captured
+        board[end_sq] = EMPTY
+        return not attacked
+
+    '''
+    True if the castle (an entry of CASTLES) can be played: the right is still there, the squares between
+    king and rook are empty and the king is not in check and does not go through an attacked square
+    '''
+    def can_castle(self, castle, enemy_color):
+        right, king_end, rook_sq, empty_squares, safe_squares = castle
+        if not self.castling_rights & right:
+            return False
+        board = self.board
+        for sq in empty_squares:
+            if board[sq] != EMPTY:
+                return False
+        king_sq = self.black_king_location if enemy_color == WHITE else self.white_king_location
+        if self.is_square_attacked(king_sq, enemy_color):
+            return False
+        for sq in safe_squares:
+            if self.is_square_attacked(sq, enemy_color):
+                return False
+        return True
+
+    '''
+    All moves considering checks see naive approach for a simpler explanation. This one is an advanced one
+    gen selects captures, quiet moves or both (GEN_*) and start_sq, a 0-63 square like in the packed moves,
+    keeps only the moves of that piece
+    '''
+    def generate_moves(self, gen=GEN_ALL, start_sq=None):
+        moves = array('H')
+        self.in_check, self.pins, self.checks = self.get_pins_and_checks()
+        if self.debug:
+            in_check, pins, checks = self.checks_for_pins_and_checks()
+            assert in_check == self.in_check and pins == self.pins and sorted(checks) == sorted(self.checks), \
+                "incremental pins and checks are out of date"
+            assert self.zobrist_key == self.compute_zobrist_key(), "incremental zobrist key is out of date"
+        if self.white_to_move:
+            king_sq = self.white_king_location
+        else:
+            king_sq = self.black_king_location
+        if start_sq is not None:
+            start_sq = SQ120[start_sq]
         if self.in_check:
-            if len(self.checks) == 1:
-                moves = self.get_all_moves()
-                #to blick a check you must have a piece into one of the square between the enemy piece and king
-                check = self.checks[0]
-                check_row = check[0]
-                check_col = check[1]
-                piece_checking = self.board[check_row][check_col]
-                #squares pieces can move to
-                valid_squares = []
-                #if knight, must capture knight or move the king
-                if piece_checking[1] == 'N':
-                    valid_squares = [(check_row, check_col)]
-                else:
-                    for i in range(1,8):
-                        #check 2 and 3 are the directions
-                        valid_square = (king_row + check[2]*i, king_col + check[3]*i)
-                        valid_squares.append(valid_square)
-                        if valid_square[0] == check_row and valid_square[1] == check_col:
-                            break
-                #get rid of any moves that don't block the check or move king
-                for i in range(len(moves)-1,-1,-1):
-                    if moves[i].piece_moved[1] != 'K':
-                        if (moves[i].end_row, moves[i].end_col) not in valid_squares:
-                            moves.remove(moves[i])
-                #double check
-            else:
-                self.get_king_moves(king_row,king_col,moves)
+            self.get_evasion_moves(king_sq, moves, gen, start_sq)
+        elif start_sq is None:
+            moves = self.get_all_moves(gen)
         else:
-            moves = self.get_all_moves()
+            self.get_piece_moves(start_sq, moves, gen)
         return moves
 
+    '''
+    Squares pieces other than the king can move to when there is a single check
+    '''
+    def get_block_squares(self, king_sq):
+        #to blick a check you must have a piece into one of the square between the enemy piece and king
+        #or capture it, a knight or a pawn has no squares in between so only the capture is left
+        check_sq = self.checks[0][0]
+        return (check_sq,) + BETWEEN_SQUARES[king_sq][check_sq]
+
+    '''
+    Moves out of check, generated straight from the squares that answer it instead of filtering every move.
+    King moves first, then (single check only) for the checker's square and the squares in between
+    the pieces that can reach them are found by looking backwards from the square.
+    A pinned piece can never answer a check, so pinned pieces are skipped
+    '''
+    def get_evasion_moves(self, king_sq, moves, gen=GEN_ALL, start_sq=None):
+        if start_sq is None or start_sq == king_sq:
+            self.get_king_moves(king_sq, moves, gen)
+        #double check, only the king can move
+        if len(self.checks) > 1:
+            return
+        board = self.board
+        pins = self.pins
+        if self.white_to_move:
+            forward = -10
+            start_row = 6
+            ally_color, enemy_color = WHITE, BLACK
+        else:
+            forward = 10
+            start_row = 1
+            ally_color, enemy_color = BLACK, WHITE
+        ally_pawn = ally_color | PAWN
+        ally_knight = ally_color | KNIGHT
+        check_sq = self.checks[0][0]
+        #the squares in between are needed for the captures too, a pawn promoting there is in the capture gen
+        for end_sq in self.get_block_squares(king_sq):
+            if end_sq != check_sq and not gen & GEN_QUIETS and ROW_COL[end_sq][0] != (0 if ally_color == WHITE else 7):
+                continue
+            from_squares = [sq for sq in KNIGHT_TARGETS[end_sq] if board[sq] == ally_knight]
+            if end_sq == check_sq:
+                #the pawns that could capture on end_sq sit where an enemy pawn on end_sq would capture
+                from_squares.extend(sq for sq in PAWN_CAPTURE_TARGETS[enemy_color][end_sq] if board[sq] == ally_pawn)
+            else:
+                sq = end_sq - forward
+                if board[sq] == ally_pawn:
+                    from_squares.append(sq)
+                elif board[sq] == EMPTY and board[sq - forward] == ally_pawn and ROW_COL[sq - forward][0] == start_row:
+                    from_squares.append(sq - forward)
+            for j, d in enumerate(DIRECTIONS):
+                sq = end_sq + d
+                piece = board[sq]
+                while piece == EMPTY:
+                    sq += d
+                    piece = board[sq]
+                if piece & ally_color:
+                    type = piece & PIECE_TYPE
+                    if type == QUEEN or type == (ROOK if j <= 3 else BISHOP):
+                        from_squares.append(sq)
+            end_bits = END_BITS[end_sq]
+            promotes = ROW_COL[end_sq][0] in (0, 7)
+            for sq in from_squares:
+                if sq not in pins and (start_sq is None or sq == start_sq):
+                    if promotes and board[sq] == ally_pawn:
+                        if gen & GEN_CAPTURES:
+                            for flag in PROMOTION_FLAGS:
+                                moves.append(SQ64[sq] | end_bits | flag)
+                    elif gen & (GEN_CAPTURES if end_sq == check_sq else GEN_QUIETS):
+                        moves.append(SQ64[sq] | end_bits)
+        #taking the pawn that just moved two squares and gives check
+        end_sq = self.en_passant_sq
+        if end_sq and gen & GEN_CAPTURES:
+            for sq in PAWN_CAPTURE_TARGETS[enemy_color][end_sq]:
+                if board[sq] == ally_pawn and (start_sq is None or sq == start_sq) and \
+                        self.is_en_passant_legal(sq, end_sq):
+                    moves.append(SQ64[sq] | END_BITS[end_sq])
+
+    '''
+    Number of valid moves, same pin and check logic as generate_moves but nothing is appended anywhere.
+    Used for the last ply of perft and for mobility
+    '''
+    def count_valid_moves(self):
+        self.in_check, self.pins, self.checks = self.get_pins_and_checks()
+        if self.white_to_move:
+            king_sq = self.white_king_location
+            ally_color, enemy_color = WHITE, BLACK
+        else:
+            king_sq = self.black_king_location
+            ally_color, enemy_color = BLACK, WHITE
+        board = self.board
+        count = 0
+        #king moves
+        valid_pieces = GEN_TARGETS[GEN_ALL][ally_color]
+        attacked = None
+        for end_sq in KING_TARGETS[king_sq]:
+            if board[end_sq] in valid_pieces:
+                if attacked is None:
+                    attacked = self.get_attack_map(enemy_color)
+                if not attacked[end_sq]:
+                    count += 1
+        if len(self.checks) > 1:
+            return count
+        if not self.in_check and self.castling_rights:
+            for castle in CASTLES[ally_color]:
+                if self.can_castle(castle, enemy_color):
+                    count += 1
+        valid_squares = self.get_block_squares(king_sq) if self.in_check else None
+        pins = self.pins
+        en_passant_sq = self.en_passant_sq
+        if ally_color == WHITE:
+            forward, start_row, last_row = -10, 6, 0
+        else:
+            forward, start_row, last_row = 10, 1, 7
+        for sq in self.piece_squares[ally_color]:
+            type = board[sq] & PIECE_TYPE
+            pin_direction = pins.get(sq)
+            if type == PAWN:
+                end_sq = sq + forward
+                #each promotion is four moves
+                moves_per_target = 4 if ROW_COL[end_sq][0] == last_row else 1
+                if board[end_sq] == EMPTY and (pin_direction is None or pin_direction == forward or
+                                               pin_direction == -forward):
+                    if valid_squares is None or end_sq in valid_squares:
+                        count += moves_per_target
+                    end_sq += forward
+                    if ROW_COL[sq][0] == start_row and board[end_sq] == EMPTY and \
+                            (valid_squares is None or end_sq in valid_squares):
+                        count += 1
+                for end_sq in PAWN_CAPTURE_TARGETS[ally_color][sq]:
+                    if board[end_sq] & enemy_color:
+                        if (pin_direction is None or pin_direction == end_sq - sq) and \
+                                (valid_squares is None or end_sq in valid_squares):
+                            count += moves_per_target
+                    elif end_sq == en_passant_sq and self.is_en_passant_legal(sq, end_sq):
+                        count += 1
+            elif type == KNIGHT:
+                if pin_direction is None:
+                    for end_sq in KNIGHT_TARGETS[sq]:
+                        if board[end_sq] in valid_pieces and (valid_squares is None or end_sq in valid_squares):
+                            count += 1
+            elif type != KING:
+                for d in SLIDER_DIRECTIONS[type]:
+                    if pin_direction is None or pin_direction == d or pin_direction == -d:
+                        end_sq = sq + d
+                        end_piece = board[end_sq]
+                        while end_piece == EMPTY:
+                            if valid_squares is None or end_sq in valid_squares:
+                                count += 1
+                            end_sq += d
+                            end_piece = board[end_sq]
+                        if end_piece & enemy_color and (valid_squares is None or end_sq in valid_squares):
+                            count += 1
+        return count
+
+    '''
+    Number of leaf nodes of the move tree depth plies deep, the standard check of a move generator.
+    The last ply is only counted, not played
+    '''
+    def perft(self, depth):
+        if depth == 0:
+            return 1
+        if depth == 1:
+            return self.count_valid_moves()
+        nodes = 0
+        for move_id in self.get_valid_move_ids():
+            self.make_move_id(move_id)
+            nodes += self.perft(depth - 1)
+            self.undo_move()
+        return nodes
+
+    '''
+    Full recomputation of the pins and checks, used as the debug cross check
+    '''
     def checks_for_pins_and_checks(self):
-        pins = []
+        pins = {}
         checks = []
         in_check = False
         if self.white_to_move:
-            enemy_color = 'b'
-            ally_color = 'w'
-            start_row = self.white_king_location[0]
-            start_col = self.white_king_location[1]
+            enemy_color = BLACK
+            ally_color = WHITE
+            start_sq = self.white_king_location
         else:
-            enemy_color = 'w'
-            ally_color = 'b'
-            start_row = self.black_king_location[0]
-            start_col = self.black_king_location[1]
+            enemy_color = WHITE
+            ally_color = BLACK
+            start_sq = self.black_king_location
+        board = self.board
         #check outward for king for pins and checks, keep tacks of pins abd checksum
-        directions = ((-1,0),(0,-1),(1,0),(0,1),(-1,-1),(-1,1),(1,-1),(1,1))
-        for j in range(len(directions)):
-            d = directions[j]
+        for j in range(len(DIRECTIONS)):
+            d = DIRECTIONS[j]
             possible_pin = ()
-            for i in range(1,8):
-                end_row = start_row + d[0] * i
-                end_col = start_col + d[1] * i
-                if 0 <= end_row < 8 and 0 <= end_col < 8:
-                    end_piece = self.board[end_row][end_col]
-                    if end_piece[0] == ally_color and end_piece[1] != 'K':
+            end_sq = start_sq + d
+            i = 1
+            #the sentinel ends the ray, no need to check the coordinates
+            while board[end_sq] != OFFBOARD:
+                end_piece = board[end_sq]
+                if end_piece & ally_color and end_piece & PIECE_TYPE != KING:
+                    if possible_pin == ():
+                        possible_pin = (end_sq, d)
+                    else:
+                        break
+                elif end_piece & enemy_color:
+                    type = end_piece & PIECE_TYPE
+                    # 4. possiblilites (pawns are checked with the table below)
+                    # when the enemy piece is orthogonally away and it's a rook
+                    # when the enemy piece is diagonally away and it's a bishop
+                    # any direction when it's a queen
+                    # any direction within 1 square and it's a king
+                    if (0 <= j <= 3 and type == ROOK) or \
+                            (4 <= j <= 7 and type == BISHOP) or \
+                            (type == QUEEN) or (i == 1 and type == KING):
                         if possible_pin == ():
-                            possible_pin = (end_row, end_col, d[0], d[1])
-                        else:
+                            in_check = True
+                            checks.append((end_sq, d))
                             break
-                    elif end_piece[0] == enemy_color:
-                        type = end_piece[1]
-                        # 5. possiblilites
-                        # when the enemy piece is orthogonally away and it's a rook
-                        # when the enemy piece is diagonally away and it's a bishop
-                        # 1 square away diagonally from the king and it's a pawn
-                        # any direction when it's a queen
-                        # any direction within 1 square and it's a king
-                        if (0 <= j <= 3 and type == 'R') or \
-                                (4 <= j <= 7 and type == 'B') or \
-                                (i == 1 and type == 'p' and \
-                                ((enemy_color == 'w' and 6 <= j <= 7) or \
-                                (enemy_color == 'b' and 4 <= j <= 5))) or \
-                                (type == 'Q') or (i == 1 and type == 'K'):
-                            if possible_pin == ():
-                                in_check = True
-                                checks.append((end_row,end_col,d[0],d[1]))
-                                break
-                            else:
-                                pins.append(possible_pin)
-                                break
                         else:
+                            pins[possible_pin[0]] = possible_pin[1]
                             break
+                    else:
+                        break
+                end_sq += d
+                i += 1
         #checks for knight moves
-        knight_moves = ((-2,-1),(-2,1),(-1,-2),(-1,2),(2,-1),(2,1),(1,-2),(1,2))
-        for m in knight_moves:
-            end_row = start_row + m[0]
-            end_col = start_row + m[1]
-            if 0 <= end_row < 8 and 0 <= end_col < 8:
-                end_piece = self.board[end_row][end_col]
-                if end_piece[0] == enemy_color and end_piece == 'N':
-                    in_check = True
-                    checks.append((end_row, end_col, m[0],m[1]))
+        enemy_knight = enemy_color | KNIGHT
+        for end_sq in KNIGHT_TARGETS[start_sq]:
+            if board[end_sq] == enemy_knight:
+                in_check = True
+                checks.append((end_sq, end_sq - start_sq))
+        #checks for pawns, the enemy pawns attacking the king stand where our own pawn would capture
+        enemy_pawn = enemy_color | PAWN
+        for end_sq in PAWN_CAPTURE_TARGETS[ally_color][start_sq]:
+            if board[end_sq] == enemy_pawn:
+                in_check = True
+                checks.append((end_sq, end_sq - start_sq))
         return in_check, pins, checks
 
     '''
     All moves wihtout considering checks
     '''
-    def get_all_moves(self):
-        moves = []
-        #we go through the board
-        for r in range(len(self.board)):
-            for c in range(len(self.board[r])):
-                piece_color = self.board[r][c][0]
-                if (piece_color == 'w' and self.white_to_move) or (piece_color == 'b' and not self.white_to_move):
-                    piece = self.board[r][c][1]
-                    self.move_functions[piece](r,c,moves)
+    def get_all_moves(self, gen=GEN_ALL):
+        moves = array('H')
+        board = self.board
+        move_functions = self.move_functions
+        #we go through the pieces of the side to move only
+        for sq in self.piece_squares[WHITE if self.white_to_move else BLACK]:
+            move_functions[board[sq] & PIECE_TYPE](sq,moves,gen)
         return moves
 
-    '''Get all the pawn moves for the pawn at the r and c adding this to the list'''
+    '''
+    Moves without considering checks of the piece at the square sq, if it belongs to the side to move
+    '''
+    def get_piece_moves(self, sq, moves, gen=GEN_ALL):
+        piece = self.board[sq]
+        if piece & (WHITE if self.white_to_move else BLACK):
+            self.move_functions[piece & PIECE_TYPE](sq, moves, gen)
 
-    def get_pawn_moves(self, r, c, moves):
-        piece_pinned = False
-        pin_direction = ()
-        for i in range(len(self.pins)-1,-1,-1):
-            if self.pins[i][0] == r and self.pins[i][1] == c:
-                piece_pinned = True
-                pin_direction = (self.pins[i][2],self.pins[i][3])
-                self.pins.remove((self.pins[i]))
-                break
+    '''Get all the pawn moves for the pawn at the square sq adding this to the list'''
 
+    def get_pawn_moves(self, sq, moves, gen=GEN_ALL):
+        board = self.board
+        pin_direction = self.pins.get(sq)
         if self.white_to_move:
-            if self.board[r-1][c] == '--':
-                if not piece_pinned or pin_direction == (-1,0):
-                    moves.append(Move((r,c),(r-1,c),self.board))
-                    if r==6 and self.board[r-2][c] == '--':
-                        moves.append(Move((r,c),(r-2,c),self.board))
-
-            #captures
-            #captures to the left
-            if c-1 >= 0:
-                if self.board[r-1][c-1][0] == 'b' and not piece_pinned or pin_direction == (-1,-1):
-                        moves.append(Move((r,c),(r-1,c-1),self.board))
-            #captures to the right
-            if c+1 <= 7:
-                if self.board[r-1][c+1][0] == 'b' and not piece_pinned or pin_direction == (-1,1):
-                        moves.append(Move((r,c),(r-1,c+1),self.board))
+            forward = -10
+            start_row = 6
+            ally_color, enemy_color = WHITE, BLACK
         else:
-            if self.board[r+1][c] == '--':
-                if not piece_pinned or pin_direction == (1,0):
-                    moves.append(Move((r,c),(r+1,c),self.board))
-                    if r==1 and self.board[r+2][c] == '--':
-                        moves.append(Move((r,c),(r+2,c),self.board))
-
-            #captures
-            #captures to the left
-            if c-1 >= 0:
-                if self.board[r+1][c-1][0] == 'w' and not piece_pinned or pin_direction == (1,-1):
-                        moves.append(Move((r,c),(r+1,c-1),self.board))
-            #captures to the right
-            if c+1 <= 7:
-                if self.board[r+1][c+1][0] == 'w' and not piece_pinned or pin_direction == (1,1):
-                        moves.append(Move((r,c),(r+1,c+1),self.board))
-
-    '''Get all the rook moves for the pawn at the r and c adding this to the list'''
-
-    def get_rook_moves(self, r, c, moves):
-        piece_pinned = False
-        pin_direction = ()
-        for i in range(len(self.pins)-1,-1,-1):
-            if self.pins[i][0] == r and self.pins[i][1] == c:
-                piece_pinned = True
-                pin_direction = (self.pins[i][2],self.pins[i][3])
-                if self.board[r][c][1] != 'Q':
-                    self.pins.remove((self.pins[i]))
-                break
+            forward = 10
+            start_row = 1
+            ally_color, enemy_color = BLACK, WHITE
 
-        directions = ((-1,0),(0,-1),(1,0),(0,1))
-        enemy_color = 'b' if self.white_to_move else 'w'
-        for d in directions:
-            for i in range(1,8):
-                end_row = r + d[0] * i
-                end_col = c + d[1] * i
-                #on board
-                if 0 <= end_row < 8 and 0 <= end_col < 8:
-                    if not piece_pinned or pin_direction ==d or pin_direction == (-d[0],-d[1]):
-                        end_piece = self.board[end_row][end_col]
-                        if end_piece == '--':
-                            moves.append(Move((r,c),(end_row,end_col),self.board))
-                        #enemy piece valid
-                        elif end_piece[0] == enemy_color:
-                            moves.append(Move((r,c),(end_row,end_col),self.board))
-                            break
-                        #friendly piece
-                        else:
-                            break
-                #off boarder
+        start = SQ64[sq]
+        end_sq = sq + forward
+        #promotions are generated with the captures, quiet or not they change the material
+        promotes = ROW_COL[end_sq][0] == (0 if ally_color == WHITE else 7)
+        if board[end_sq] == EMPTY and (gen & GEN_CAPTURES if promotes else gen & GEN_QUIETS):
+            #a pawn pinned along its file can still move towards the pinner or the king
+            if pin_direction is None or pin_direction == forward or pin_direction == -forward:
+                if promotes:
+                    for flag in PROMOTION_FLAGS:
+                        moves.append(start | END_BITS[end_sq] | flag)
                 else:
-                    break
+                    moves.append(start | END_BITS[end_sq])
+                    if ROW_COL[sq][0] == start_row and board[end_sq + forward] == EMPTY:
+                        moves.append(start | END_BITS[end_sq + forward])
 
-    '''Get all the knight moves for the pawn at the r and c adding this to the list'''
+        #captures to the left and to the right
+        if gen & GEN_CAPTURES:
+            for end_sq in PAWN_CAPTURE_TARGETS[ally_color][sq]:
+                if board[end_sq] & enemy_color:
+                    if pin_direction is None or pin_direction == end_sq - sq:
+                        if promotes:
+                            for flag in PROMOTION_FLAGS:
+                                moves.append(start | END_BITS[end_sq] | flag)
+                        else:
+                            moves.append(start | END_BITS[end_sq])
+                #the pin is checked on the board, see is_en_passant_legal
+                elif end_sq == self.en_passant_sq and self.is_en_passant_legal(sq, end_sq):
+                    moves.append(start | END_BITS[end_sq])
 
-    def get_knight_moves(self, r, c, moves):
-        piece_pinned = False
-        for i in range(len(self.pins)-1,-1,-1):
-            if self.pins[i][0] == r and self.pins[i][1] == c:
-                piece_pinned = True
-                self.pins.remove((self.pins[i]))
-                break
+    '''Get all the sliding moves along the directions for the piece at the square sq adding this to the list'''
 
-        directions = ((-2,-1),(-2,1),(-1,-2),(-1,2),(2,-1),(2,1),(1,-2),(1,2))
-        enemy_color = 'b' if self.white_to_move else 'w'
+    def get_sliding_moves(self, sq, moves, directions, gen=GEN_ALL):
+        board = self.board
+        pin_direction = self.pins.get(sq)
+        enemy_color = BLACK if self.white_to_move else WHITE
+        start = SQ64[sq]
+        quiets = gen & GEN_QUIETS
+        captures = gen & GEN_CAPTURES
         for d in directions:
-            end_row = r + d[0]
-            end_col = c + d[1]
-            #on board
-            if 0 <= end_row < 8 and 0 <= end_col < 8:
-                if not piece_pinned:
-                    end_piece = self.board[end_row][end_col]
-                    #enemy piece valid
-                    if (end_piece[0] == enemy_color) or (end_piece == "--"):
-                        moves.append(Move((r,c),(end_row,end_col),self.board))
-
-    '''Get all the bishop moves for the pawn at the r and c adding this to the list'''
-
-    def get_bishop_moves(self, r, c, moves):
-        piece_pinned = False
-        pin_direction = ()
-        for i in range(len(self.pins)-1,-1,-1):
-            if self.pins[i][0] == r and self.pins[i][1] == c:
-                piece_pinned = True
-                pin_direction = (self.pins[i][2],self.pins[i][3])
-                if self.board[r][c][1] != 'Q':
-                    self.pins.remove((self.pins[i]))
-                break
+            if pin_direction is None or pin_direction == d or pin_direction == -d:
+                end_sq = sq + d
+                end_piece = board[end_sq]
+                while end_piece == EMPTY:
+                    if quiets:
+                        moves.append(start | END_BITS[end_sq])
+                    end_sq += d
+                    end_piece = board[end_sq]
+                #enemy piece valid, friendly pieces and the sentinel stop the ray
+                if end_piece & enemy_color and captures:
+                    moves.append(start | END_BITS[end_sq])
 
-        directions = ((-1,-1),(-1,1),(1,-1),(1,1))
-        enemy_color = 'b' if self.white_to_move else 'w'
-        for d in directions:
-            for i in range(1,8):
-                end_row = r + d[0] * i
-                end_col = c + d[1] * i
-                #on board
-                if 0 <= end_row < 8 and 0 <= end_col < 8:
-                    if not piece_pinned or pin_direction ==d or pin_direction == (-d[0],-d[1]):
-                        end_piece = self.board[end_row][end_col]
-                        if end_piece == '--':
-                            moves.append(Move((r,c),(end_row,end_col),self.board))
-                        #enemy piece valid
-                        elif end_piece[0] == enemy_color:
-                            moves.append(Move((r,c),(end_row,end_col),self.board))
-                            break
-                        #friendly piece
-                        else:
-                            break
-                #off boarder
-                else:
-                    break
-    '''Get all the queen moves for the pawn at the r and c adding this to the list'''
+    '''Get all the rook moves for the rook at the square sq adding this to the list'''
 
-    def get_queen_moves(self, r, c, moves):
-        self.move_functions['R'](r,c,moves)
-        self.move_functions['B'](r,c,moves)
-    '''Get all the king moves for the pawn at the r and c adding this to the list'''
+    def get_rook_moves(self, sq, moves, gen=GEN_ALL):
+        self.get_sliding_moves(sq, moves, DIRECTIONS[:4], gen)
 
-    def get_king_moves(self, r, c, moves):
+    '''Get all the knight moves for the knight at the square sq adding this to the list'''
 
-        directions = ((-1,0),(0,-1),(1,0),(0,1),(-1,-1),(-1,1),(1,-1),(1,1))
-        enemy_color = 'b' if self.white_to_move else 'w'
-        for d in directions:
-            end_row = r + d[0]
-            end_col = c + d[1]
-            #on board
-            if 0 <= end_row < 8 and 0 <= end_col < 8:
-                end_piece = self.board[end_row][end_col]
-                if end_piece[0] == enemy_color or end_piece =='--':
-                    if enemy_color == 'b':
-                        self.white_king_location = (end_row,end_col)
-                    else:
-                        self.black_king_location = (end_row,end_col)
-                    in_check, pins, checks = self.checks_for_pins_and_checks()
-                    if not in_check:
-                        moves.append(Move((r,c),(end_row,end_col), self.board))
-                    if enemy_color == 'b':
-                        self.white_king_location = (r,c)
-                    else:
-                        self.black_king_location = (r,c)
+    def get_knight_moves(self, sq, moves, gen=GEN_ALL):
+        #a pinned knight can never move
+        if sq in self.pins:
+            return
+        board = self.board
+        #empty squares for the quiet moves and enemy pieces for the captures
+        targets = GEN_TARGETS[gen][WHITE if self.white_to_move else BLACK]
+        start = SQ64[sq]
+        for end_sq in KNIGHT_TARGETS[sq]:
+            if board[end_sq] in targets:
+                moves.append(start | END_BITS[end_sq])
+
+    '''Get all the bishop moves for the bishop at the square sq adding this to the list'''
+
+    def get_bishop_moves(self, sq, moves, gen=GEN_ALL):
+        self.get_sliding_moves(sq, moves, DIRECTIONS[4:], gen)
+
+    '''Get all the queen moves for the queen at the square sq adding this to the list'''
+
+    def get_queen_moves(self, sq, moves, gen=GEN_ALL):
+        self.get_sliding_moves(sq, moves, DIRECTIONS, gen)
+
+    '''Get all the king moves for the king at the square sq adding this to the list'''
+
+    def get_king_moves(self, sq, moves, gen=GEN_ALL):
+        board = self.board
+        if self.white_to_move:
+            ally_color, enemy_color = WHITE, BLACK
+        else:
+            ally_color, enemy_color = BLACK, WHITE
+        #empty or enemy piece valid
+        valid_pieces = GEN_TARGETS[gen][ally_color]
+        targets = [end_sq for end_sq in KING_TARGETS[sq] if board[end_sq] in valid_pieces]
+        if targets:
+            #as long as the enemy does not attack it
+            attacked = self.get_attack_map(enemy_color)
+            for end_sq in targets:
+                if not attacked[end_sq]:
+                    moves.append(SQ64[sq] | END_BITS[end_sq])
+        if gen & GEN_QUIETS and self.castling_rights and not self.in_check:
+            for castle in CASTLES[ally_color]:
+                if self.can_castle(castle, enemy_color):
+                    moves.append(SQ64[sq] | END_BITS[castle[1]])
+
+    '''
+    Attack map of the pieces of color, attacked[sq] is 1 when one of them attacks the mailbox square sq.
+    The king of the other side does not block the sliders, so it cannot step back along the ray that checks it
+    '''
+    def get_attack_map(self, color):
+        board = self.board
+        attacked = bytearray(120)
+        enemy_king = (color ^ (WHITE | BLACK)) | KING
+        for sq in self.piece_squares[color]:
+            type = board[sq] & PIECE_TYPE
+            if type == PAWN:
+                for end_sq in PAWN_CAPTURE_TARGETS[color][sq]:
+                    attacked[end_sq] = 1
+            elif type == KNIGHT:
+                for end_sq in KNIGHT_TARGETS[sq]:
+                    attacked[end_sq] = 1
+            elif type == KING:
+                for end_sq in KING_TARGETS[sq]:
+                    attacked[end_sq] = 1
+            else:
+                for d in SLIDER_DIRECTIONS[type]:
+                    end_sq = sq + d
+                    end_piece = board[end_sq]
+                    while end_piece != OFFBOARD:
+                        attacked[end_sq] = 1
+                        if end_piece != EMPTY and end_piece != enemy_king:
+                            break
+                        end_sq += d
+                        end_piece = board[end_sq]
+        return attacked
 
 class Move():
 
@@ -366,27 +1324,123 @@ class Move():
                      "f": 5, "g": 6, "h": 7}
     cols_to_files = {v: k for k, v in files_to_cols.items()}
 
-    def __init__(self, start_sq, end_sq, board):
-        self.start_row = start_sq[0]
-        self.start_col = start_sq[1]
-        self.end_row = end_sq[0]
-        self.end_col = end_sq[1]
-        self.piece_moved = board[self.start_row][self.start_col]
-        self.piece_captured = board[self.end_row][self.end_col]
-        self.move_id = self.start_row * 1000 + self.start_col * 100 + self.end_row * 10 + self.end_col
-        #print(self.move_id)
+    #no __dict__ per move, and one shared instance per packed move
+    __slots__ = ('start_row', 'start_col', 'end_row', 'end_col', 'move_id')
+    interned = {}
 
     '''
-    Overriding the equal method
+    Moves are interned by move_id so equal moves are the same object, equality and hashing are
+    the default identity ones. The pieces are read from the board when the move is made,
+    so board is only kept for the callers
     '''
-    def __eq__(self, other):
-        if isinstance(other,Move):
-            return self.move_id == other.move_id
-        return False
+    def __new__(cls, start_sq, end_sq, board=None):
+        #the packed move, see SQ64
+        move_id = start_sq[0] * 8 + start_sq[1] | (end_sq[0] * 8 + end_sq[1]) << 6
+        #with the board a pawn reaching the last row becomes a queen
+        if board is not None and board[mailbox_square(*start_sq)] & PIECE_TYPE == PAWN and end_sq[0] in (0, 7):
+            move_id |= QUEEN << PROMOTION_SHIFT
+        return cls.from_move_id(move_id)
+
+    '''
+    The Move for a packed move, only needed for the UI and the notation
+    '''
+    @classmethod
+    def from_move_id(cls, move_id):
+        move = cls.interned.get(move_id)
+        if move is None:
+            move = object.__new__(cls)
+            move.start_row, move.start_col = divmod(move_id & 63, 8)
+            move.end_row, move.end_col = divmod(move_id >> 6 & 63, 8)
+            move.move_id = move_id
+            cls.interned[move_id] = move
+        return move
+
+    #unpickled moves go through the table as well
+    def __reduce__(self):
+        return (Move.from_move_id, (self.move_id,))
 
     def get_chess_notation(self):
         #Can be change to real chess notation
-        return self.get_rank_file(self.start_row, self.start_col) + self.get_rank_file(self.end_row, self.end_col)
+        notation = self.get_rank_file(self.start_row, self.start_col) + self.get_rank_file(self.end_row, self.end_col)
+        if self.move_id >> PROMOTION_SHIFT:
+            notation += PIECE_NAMES[WHITE | self.move_id >> PROMOTION_SHIFT][1].lower()
+        return notation
 
     def get_rank_file(self, r, c):
-        return self.cols_to_files[c] + self.rows_to_ranks[r]
\ No newline at end of file
+        return self.cols_to_files[c] + self.rows_to_ranks[r]
+
+
+class Position(bytes):
+
+    """
+    A position as an immutable value: the 64 piece codes from a8 to h1, side to move, castling rights and the
+    en passant square, packed like POSITION. Two positions are equal when the same moves are possible
+    from them, so the counters are left out. It is a bytes object, hashing and comparing are the bytes ones
+    and the hash is cached, so it works as a dict key or in a set without extra memory
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_game_state(cls, gs):
+        return gs.position()
+
+    '''
+    A new GameState with this position, backend works like in GameState()
+    '''
+    def to_game_state(self, backend=None):
+        gs = GameState(backend)
+        gs.load_position(self)
+        return gs
+
+    @property
+    def squares(self):
+        return self[:64]
+
+    @property
+    def white_to_move(self):
+        return self[64] != 0
+
+    @property
+    def castling_rights(self):
+        return self[65]
+
+    @property
+    def en_passant_sq(self):
+        return self[66]
+
+    def __repr__(self):
+        return "Position({})".format(bytes.__repr__(self))
+
+
+class MoveCache():
+
+    """
+    Bounded cache of the valid moves of positions, keyed by the zobrist key. The moves are kept as bytes of
+    packed moves so they cannot be changed, and the least recently used position is dropped when the
+    cache is full. hits and misses count the lookups
+    """
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        moves = self.entries.get(key)
+        if moves is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return moves
+
+    def put(self, key, moves):
+        self.entries[key] = moves
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
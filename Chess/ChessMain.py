@@ -33,9 +33,6 @@ def main():
     clock = p.time.Clock()
     screen.fill(p.Color("white"))
     gs = ChessEngine.GameState()
-    valid_moves = gs.get_valid_moves()
-    #flag variable for when a move is made
-    move_made = False
     load_images()
     running = True
     #no square is selected. Meant to hold the tuple of the last click event
@@ -64,9 +61,9 @@ def main():
                 if len(player_clicks) == 2:
                     move = ChessEngine.Move(player_clicks[0], player_clicks[1], gs.board)
                     print(move.get_chess_notation())
-                    if move in valid_moves:
+                    #only the clicked move is checked, the list of valid moves is not needed
+                    if gs.is_legal(move):
                         gs.make_move(move)
-                        move_made = True
                         #reset user clicks
                         sq_selected = ()
                         player_clicks = []
@@ -78,10 +75,6 @@ def main():
                     #when pressing z
                     if e.key == p.K_z:
                         gs.undo_move()
-                        move_made = True
-        if move_made == True:
-            valid_moves = gs.get_valid_moves()
-            move_made = False
         draw_game_state(screen,gs)
         clock.tick(MAX_FPS)
         p.display.flip()
@@ -114,9 +107,9 @@ Draw the pieces on the board using the current GameState.board
 def draw_pieces(screen, board):
     for r in range(DIMENSION):
         for c in range(DIMENSION):
-            piece = board[r][c]
-            if piece != "--":
-                screen.blit(IMAGES[piece], p.Rect(c*SQ_SIZE,r*SQ_SIZE,SQ_SIZE,SQ_SIZE))
+            piece = board[ChessEngine.mailbox_square(r, c)]
+            if piece != ChessEngine.EMPTY:
+                screen.blit(IMAGES[ChessEngine.PIECE_NAMES[piece]], p.Rect(c*SQ_SIZE,r*SQ_SIZE,SQ_SIZE,SQ_SIZE))
 
 
 
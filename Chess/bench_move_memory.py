@@ -0,0 +1,69 @@
+'''
+Memory benchmark for Move objects.
+Keeps the legal moves of a few thousand positions alive, as the analysis trees do, and reports the bytes
+per move of the old Move (one object with a __dict__ and seven attributes per generated move) against the
+slotted, interned Move. Run it from the Chess folder: python bench_move_memory.py
+'''
+
+import random
+import tracemalloc
+from array import array
+
+import ChessEngine
+
+POSITIONS = 2000
+
+
+class DictMove():
+
+    #the Move before __slots__ and interning, every generated move was a new object
+    def __init__(self, move_id, board):
+        self.start_row, self.start_col = divmod(move_id & 63, 8)
+        self.end_row, self.end_col = divmod(move_id >> 6 & 63, 8)
+        self.piece_moved = board[ChessEngine.mailbox_square(self.start_row, self.start_col)]
+        self.piece_captured = board[ChessEngine.mailbox_square(self.end_row, self.end_col)]
+        self.move_id = move_id
+
+
+def collect_positions(count, seed=0):
+    #random games, we keep the board and the packed legal moves of every position
+    rng = random.Random(seed)
+    positions = []
+    gs = ChessEngine.GameState()
+    while len(positions) < count:
+        move_ids = gs.get_valid_move_ids()
+        if not move_ids or len(gs.move_log) > 80:
+            gs = ChessEngine.GameState()
+            continue
+        positions.append((bytes(gs.board), move_ids))
+        gs.make_move_id(rng.choice(move_ids))
+    return positions
+
+
+def measure(build, positions):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    trees = [build(board, move_ids) for board, move_ids in positions]
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / sum(len(moves) for moves in trees)
+
+
+def main():
+    positions = collect_positions(POSITIONS)
+    #warm the intern table so only the references are counted, it is built once per process
+    for board, move_ids in positions:
+        for move_id in move_ids:
+            ChessEngine.Move.from_move_id(move_id)
+    old = measure(lambda board, move_ids: [DictMove(move_id, board) for move_id in move_ids], positions)
+    new = measure(lambda board, move_ids: [ChessEngine.Move.from_move_id(move_id) for move_id in move_ids], positions)
+    packed = measure(lambda board, move_ids: array('H', move_ids), positions)
+    print("moves kept alive: {}".format(sum(len(move_ids) for board, move_ids in positions)))
+    print("interned Move objects in the table: {}".format(len(ChessEngine.Move.interned)))
+    print("{:<28}{:>10.1f} bytes/move".format("Move with __dict__", old))
+    print("{:<28}{:>10.1f} bytes/move".format("slotted, interned Move", new))
+    print("{:<28}{:>10.1f} bytes/move".format("packed array('H')", packed))
+
+
+if __name__ == "__main__":
+    main()
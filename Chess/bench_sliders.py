@@ -0,0 +1,56 @@
+'''
+Benchmark of the sliding attack generation of the bitboard backend.
+Compares the magic bitboard lookups against the ray walkers they replaced, on the same random
+squares and blockers. Run it from the Chess folder: python bench_sliders.py
+'''
+
+import random
+import sys
+import timeit
+
+import BitboardEngine
+
+SAMPLES = 10000
+REPEAT = 5
+
+
+def random_positions(count, seed=0):
+    rng = random.Random(seed)
+    #about a third of the squares occupied, like a middlegame
+    return [(rng.randrange(64), rng.getrandbits(64) & rng.getrandbits(64) | rng.getrandbits(64) & rng.getrandbits(64))
+            for _ in range(count)]
+
+
+def queen_attacks_classical(sq, occupied):
+    return BitboardEngine.rook_attacks_classical(sq, occupied) | BitboardEngine.bishop_attacks_classical(sq, occupied)
+
+
+def queen_attacks(sq, occupied):
+    return BitboardEngine.rook_attacks(sq, occupied) | BitboardEngine.bishop_attacks(sq, occupied)
+
+
+def time_attacks(attacks, positions):
+    def run():
+        for sq, occupied in positions:
+            attacks(sq, occupied)
+    #best of the runs, in nanoseconds per call
+    return min(timeit.repeat(run, number=1, repeat=REPEAT)) / len(positions) * 1e9
+
+
+def main():
+    positions = random_positions(SAMPLES)
+    pairs = (("rook", BitboardEngine.rook_attacks_classical, BitboardEngine.rook_attacks),
+             ("bishop", BitboardEngine.bishop_attacks_classical, BitboardEngine.bishop_attacks),
+             ("queen", queen_attacks_classical, queen_attacks))
+    print("{:<8}{:>14}{:>14}{:>10}".format("piece", "rays ns/call", "magic ns/call", "speedup"))
+    for name, classical, magic in pairs:
+        for sq, occupied in positions:
+            if classical(sq, occupied) != magic(sq, occupied):
+                sys.exit("{} attacks differ on square {} with blockers {:#x}".format(name, sq, occupied))
+        slow = time_attacks(classical, positions)
+        fast = time_attacks(magic, positions)
+        print("{:<8}{:>14.0f}{:>14.0f}{:>9.1f}x".format(name, slow, fast, slow / fast))
+
+
+if __name__ == "__main__":
+    main()
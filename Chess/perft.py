@@ -0,0 +1,174 @@
+'''
+Perft: counts the leaf nodes of the move tree of a position to a fixed depth and compares them with the known
+counts of the standard test positions, so any move generation bug shows up as a wrong number.
+It also reports the speed as nodes per second, the results are printed as JSON.
+Run it from the Chess folder: python perft.py [--depth N] [--backend bitboard] [--position kiwipete] [--fen FEN]
+--divide adds the count under every root move and --jobs N spreads the subtrees over N processes.
+--check-legal also compares is_legal_id with the move generator on every possible packed move.
+The exit status is 1 when a count is wrong.
+'''
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import ChessEngine
+
+#name: (FEN, known node counts for depth 1, 2, 3...)
+POSITIONS = {
+    "initial": ("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+                (20, 400, 8902, 197281, 4865609, 119060324)),
+    "kiwipete": ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+                 (48, 2039, 97862, 4085603, 193690690)),
+    "position3": ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+                  (14, 191, 2812, 43238, 674624, 11030083)),
+    "position4": ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+                  (6, 264, 9467, 422333, 15833292)),
+    "position5": ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+                  (44, 1486, 62379, 2103487, 89941194)),
+    "position6": ("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+                  (46, 2079, 89890, 3894594, 164075551)),
+}
+#depths that take a few seconds at most in CPython
+DEFAULT_DEPTHS = {"initial": 4, "kiwipete": 3, "position3": 5, "position4": 4, "position5": 3, "position6": 3}
+
+
+#one GameState per worker process and backend, every snapshot is loaded on it
+_worker_states = {}
+
+
+def perft_snapshot(snapshot, depth, backend=None):
+    gs = _worker_states.get(backend)
+    if gs is None:
+        gs = _worker_states[backend] = ChessEngine.GameState(backend)
+    gs.load_snapshot(snapshot)
+    return gs.perft(depth)
+
+
+def divide(gs, depth, backend=None, jobs=1):
+    '''
+    Node count under each root move as (notation, nodes) pairs, in the order of get_valid_move_ids.
+    The subtrees are independent, so they are sent to the workers as snapshots. With more than one job
+    the tree is split after two plies, there are many more subtrees than processes and they even out
+    '''
+    root_moves = list(gs.get_valid_move_ids())
+    plies = 2 if jobs > 1 and depth >= 3 else 1
+    roots = []
+    snapshots = []
+    for i, move_id in enumerate(root_moves):
+        gs.make_move_id(move_id)
+        if plies == 2:
+            for reply in gs.get_valid_move_ids():
+                gs.make_move_id(reply)
+                roots.append(i)
+                snapshots.append(gs.snapshot())
+                gs.undo_move()
+        else:
+            roots.append(i)
+            snapshots.append(gs.snapshot())
+        gs.undo_move()
+
+    counts = [0] * len(root_moves)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            chunksize = max(1, len(snapshots) // (jobs * 8))
+            results = list(executor.map(perft_snapshot, snapshots, repeat(depth - plies), repeat(backend),
+                                        chunksize=chunksize))
+    else:
+        results = [perft_snapshot(snapshot, depth - plies, backend) for snapshot in snapshots]
+    for i, nodes in zip(roots, results):
+        counts[i] += nodes
+    return [(ChessEngine.Move.from_move_id(move_id).get_chess_notation(), nodes)
+            for move_id, nodes in zip(root_moves, counts)]
+
+
+def legal_mismatches(gs, depth=1):
+    '''
+    Packed ids on which is_legal_id disagrees with get_valid_move_ids, in the position and in every position
+    up to depth plies after it. All 4096 start and end pairs are tried with all 16 flags, so it is slow
+    '''
+    valid = set(gs.get_valid_move_ids())
+    mismatches = sum(1 for move_id in range(1 << 16) if gs.is_legal_id(move_id) != (move_id in valid))
+    if depth > 0:
+        for move_id in valid:
+            gs.make_move_id(move_id)
+            mismatches += legal_mismatches(gs, depth - 1)
+            gs.undo_move()
+    return mismatches
+
+
+def run_position(name, fen, depth, backend=None, expected=None, split=False, jobs=1, check_legal=False):
+    gs = ChessEngine.GameState.from_fen(fen, backend)
+    start = time.perf_counter()
+    #the root moves are only needed to show them or to hand them to the workers, depth 0 has none
+    if depth > 0 and (split or jobs > 1):
+        root_counts = divide(gs, depth, backend, jobs)
+        nodes = sum(count for notation, count in root_counts)
+    else:
+        root_counts = []
+        nodes = gs.perft(depth)
+    seconds = time.perf_counter() - start
+    result = {
+        "position": name,
+        "fen": fen,
+        "backend": backend or "mailbox",
+        "depth": depth,
+        "nodes": nodes,
+        "expected": expected,
+        "ok": expected is None or nodes == expected,
+        "seconds": round(seconds, 3),
+        "nps": round(nodes / seconds) if seconds > 0 else None,
+    }
+    if split:
+        result["divide"] = dict(root_counts)
+    if check_legal:
+        result["legal_mismatches"] = legal_mismatches(gs)
+        result["ok"] = result["ok"] and result["legal_mismatches"] == 0
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Perft node counts and speed of the move generator")
+    parser.add_argument("--depth", type=int, help="depth for every position, by default a few seconds each")
+    parser.add_argument("--backend", choices=("mailbox", "bitboard"), default="mailbox")
+    parser.add_argument("--position", action="append", choices=sorted(POSITIONS),
+                        help="standard position to run, can be repeated, all of them by default")
+    parser.add_argument("--fen", help="run this position instead, there is no known count to check")
+    parser.add_argument("--divide", action="store_true", help="also report the nodes under each root move")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes, the counts are the same for any")
+    parser.add_argument("--check-legal", action="store_true",
+                        help="also compare is_legal_id on every packed id with the generated moves, one ply deep")
+    args = parser.parse_args(argv)
+    backend = None if args.backend == "mailbox" else args.backend
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.depth is not None and args.depth < 0:
+        parser.error("--depth must be at least 0")
+
+    results = []
+    if args.fen:
+        try:
+            ChessEngine.GameState.from_fen(args.fen, backend)
+        except ValueError as error:
+            parser.error(str(error))
+        depth = args.depth if args.depth is not None else 3
+        results.append(run_position("fen", args.fen, depth, backend, None, args.divide, args.jobs,
+                                    args.check_legal))
+    else:
+        for name in args.position or POSITIONS:
+            fen, counts = POSITIONS[name]
+            depth = args.depth if args.depth is not None else DEFAULT_DEPTHS[name]
+            #depth 0 is the position itself
+            counts = (1,) + counts
+            expected = counts[depth] if depth < len(counts) else None
+            results.append(run_position(name, fen, depth, backend, expected, args.divide, args.jobs,
+                                        args.check_legal))
+    print(json.dumps(results, indent=2))
+    return 0 if all(result["ok"] for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())